@@ -0,0 +1,97 @@
+"""
+startup benchmark for the fast exit path.
+
+runs the updater with a date constraint that can not match and measures the
+wall time on top of a bare interpreter start. fails if the overhead exceeds
+the threshold or if one of the heavy modules gets imported on the way out.
+
+    python benchmarks/bench_startup.py --runs 20 --max_overhead_ms 50
+"""
+
+import argparse
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["httpx", "pydantic", "pydantic_settings"]
+
+RUN = """
+import sys
+sys.argv = {argv!r}
+import dlm_engine_updater
+try:
+    dlm_engine_updater.main()
+except SystemExit:
+    pass
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def blackout_today():
+    today = datetime.date.today()
+    return f"{today - datetime.timedelta(days=1)}..{today + datetime.timedelta(days=1)}"
+
+
+def timed(args, env):
+    start = time.perf_counter()
+    result = subprocess.run(
+        args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False
+    )
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fast exit startup benchmark")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--max_overhead_ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPO + os.pathsep + env.get("PYTHONPATH", "")
+
+    with tempfile.TemporaryDirectory() as basedir:
+        cfg = os.path.join(basedir, ".env")
+        with open(cfg, "w") as env_file:
+            env_file.write(f"main_basedir={basedir}\n")
+            env_file.write(f"main_log_file={os.path.join(basedir, 'startup.log')}\n")
+        argv = [
+            "dlm_engine_updater",
+            "--cfg",
+            cfg,
+            "--blackout",
+            blackout_today(),
+        ]
+        code = RUN.format(argv=argv, heavy=HEAVY_MODULES)
+
+        bare = list()
+        fast = list()
+        imported = ""
+        for _ in range(args.runs):
+            bare.append(timed([sys.executable, "-c", "pass"], env)[0])
+            duration, result = timed([sys.executable, "-c", code], env)
+            fast.append(duration)
+            imported = result.stdout.decode().strip() or imported
+
+    bare_ms = statistics.median(bare) * 1000
+    fast_ms = statistics.median(fast) * 1000
+    overhead_ms = fast_ms - bare_ms
+    print(f"interpreter start:  {bare_ms:8.1f} ms (median of {args.runs})")
+    print(f"fast exit:          {fast_ms:8.1f} ms (median of {args.runs})")
+    print(f"overhead:           {overhead_ms:8.1f} ms (limit {args.max_overhead_ms} ms)")
+    failed = False
+    if imported:
+        print(f"FAIL: heavy modules imported on the fast path: {imported}")
+        failed = True
+    if overhead_ms > args.max_overhead_ms:
+        print("FAIL: fast exit overhead above limit")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+helpers shared by the benchmarks: synthetic configuration and script trees,
+fake script users, bench plugins and a local stand-in for the lock api.
+"""
+
+import json
+import os
+import pwd
+import resource
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from dlm_engine_updater.lock import DlmEngineLock
+from dlm_engine_updater.plugin import DlmEnginePluginBase
+
+PHASES = [
+    "needs_update.d",
+    "pre_update.d",
+    "update.d",
+    "needs_reboot.d",
+    "post_update.d",
+    "ext_notify.d",
+]
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def write_config(basedir, endpoint="http://127.0.0.1:9/", noop=True, extra=None):
+    cfg = os.path.join(basedir, ".env")
+    with open(cfg, "w") as env_file:
+        env_file.write(f"main_api_noop={str(noop).lower()}\n")
+        env_file.write("main_api_lockname=bench-lock\n")
+        env_file.write(f"main_api_endpoint={endpoint}\n")
+        env_file.write("main_api_secretid=bench\n")
+        env_file.write("main_api_secret=bench\n")
+        env_file.write("main_log_level=INFO\n")
+        env_file.write(f"main_log_file={os.path.join(basedir, 'bench.log')}\n")
+        env_file.write(f"main_basedir={basedir}\n")
+        for line in extra or list():
+            env_file.write(f"{line}\n")
+    return cfg
+
+
+def write_script(path, body):
+    with open(path, "w") as script:
+        script.write("#!/bin/sh\n")
+        script.write(body)
+        script.write("\n")
+    os.chmod(path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+
+def script_tree(basedir, scripts_per_phase=1, body="exit 0", overrides=None):
+    """
+    create every phase directory with scripts_per_phase scripts, overrides
+    maps a phase directory to a script body used instead of body.
+    """
+    overrides = overrides or dict()
+    for phase in PHASES:
+        path = os.path.join(basedir, phase)
+        os.makedirs(path, exist_ok=True)
+        for number in range(scripts_per_phase):
+            write_script(
+                os.path.join(path, f"{number:04d}-bench"),
+                overrides.get(phase, body),
+            )
+
+
+def fake_users(basedir, count, scripts_per_user, phase="pre_update.d"):
+    """
+    pwd entries owned by the current uid, with a home below basedir that
+    contains scripts_per_user user scripts.
+    """
+    me = pwd.getpwuid(os.getuid())
+    users = list()
+    for number in range(count):
+        home = os.path.join(basedir, "home", f"bench{number}")
+        path = os.path.join(home, "dlm_engine_updater", phase)
+        os.makedirs(path, exist_ok=True)
+        for script in range(scripts_per_user):
+            write_script(os.path.join(path, f"{script:04d}-user{number}"), "exit 0")
+        users.append(
+            pwd.struct_passwd(
+                (f"bench{number}", "x", me.pw_uid, me.pw_gid, "", home, "/bin/sh")
+            )
+        )
+    return users
+
+
+class BenchPlugin(DlmEnginePluginBase):
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.calls = 0
+
+    def logger_pre_hook(self, level, msg, phase=None, script=None, return_code=None, **kwargs):
+        self.calls += 1
+
+    def logger_post_hook(self, level, msg, phase=None, script=None, return_code=None, **kwargs):
+        self.calls += 1
+
+
+def add_plugins(plugin_manager, count):
+    for number in range(count):
+        plugin = BenchPlugin()
+        plugin.log = plugin_manager.log
+        plugin_manager.plugins[f"bench{number}"] = plugin
+
+
+class BenchLock(DlmEngineLock):
+    """DlmEngineLock that acquires as name, the bench updaters all run on this host"""
+
+    def __init__(self, name, **kwargs):
+        super().__init__(**kwargs)
+        self._name = name
+
+    @property
+    def payload_acquire(self):
+        return {"acquired_by": self._name}
+
+
+def bench_lock(updater, name):
+    """give updater a lock that acquires as name, configured like its own"""
+    api = updater.config.main.api
+    lock = updater.config.main.lock
+    updater._dlm_lock = BenchLock(
+        name,
+        log=updater.log,
+        ca=api.ca,
+        endpoint=api.endpoint,
+        secret=api.secret,
+        secret_id=api.secretid,
+        lock_name=api.lockname,
+        wait=updater.config.main.wait,
+        wait_max=updater.config.main.waitmax,
+        noop=api.noop,
+        queue=lock.queue,
+        priority=lock.priority,
+        queue_poll=lock.queuepoll,
+    )
+    return updater._dlm_lock
+
+
+class LockHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return dict()
+        return json.loads(self.rfile.read(length))
+
+    def _queue(self):
+        """(lock path, ticket, query) of a queue request, None for lock requests"""
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[0] != "queues" or len(parts) < 2:
+            return None
+        ticket = parts[2] if len(parts) > 2 else None
+        return f"/locks/{parts[1]}", ticket, parse_qs(url.query)
+
+    def _unknown(self, queue):
+        """the api without queue extension does not know the queue routes"""
+        if queue and not self.server.queue:
+            self._reply(404, {"detail": "Not Found"})
+            return True
+        return False
+
+    def _position(self, lock, ticket):
+        """position of ticket in the queue of lock, None if the ticket is unknown"""
+        queue = self.server.queues.get(lock, [])
+        now = time.monotonic()
+        # tickets of waiters that stopped watching expire
+        queue[:] = [entry for entry in queue if now - entry["seen"] < self.server.ticket_ttl]
+        for position, entry in enumerate(queue):
+            if entry["ticket"] == ticket:
+                entry["seen"] = now
+                return position
+        return None
+
+    def do_GET(self):
+        queue = self._queue()
+        if self._unknown(queue):
+            return
+        if queue:
+            lock, ticket, query = queue
+            wait = float(query.get("wait", ["0"])[0])
+            known = int(query.get("position", ["-1"])[0])
+            end = time.monotonic() + wait
+            with self.server.changed:
+                while True:
+                    position = self._position(lock, ticket)
+                    if position is None:
+                        self._reply(404, {"detail": "ticket not found"})
+                        return
+                    # the head is answered once the lock is free
+                    ready = position == 0 and lock not in self.server.locks
+                    remaining = end - time.monotonic()
+                    if position != known or ready or remaining <= 0:
+                        break
+                    self.server.changed.wait(min(remaining, self.server.ticket_ttl / 2))
+                self.server.requests += 1
+            self._reply(200, {"ticket": ticket, "position": position})
+            return
+        with self.server.mutex:
+            lock = self.server.locks.get(self.path)
+        if lock is None:
+            self._reply(404, {"detail": "lock not found"})
+        else:
+            self._reply(200, lock)
+
+    def do_POST(self):
+        body = self._body()
+        queue = self._queue()
+        if self._unknown(queue):
+            return
+        if queue:
+            lock, _, _ = queue
+            with self.server.changed:
+                self.server.requests += 1
+                self.server.tickets += 1
+                entry = {
+                    "ticket": str(self.server.tickets),
+                    "acquired_by": body.get("acquired_by"),
+                    "priority": int(body.get("priority", 50)),
+                    "seen": time.monotonic(),
+                }
+                entries = self.server.queues.setdefault(lock, [])
+                entries.append(entry)
+                # stable, first come first served within a priority class
+                entries.sort(key=lambda x: x["priority"])
+                position = self._position(lock, entry["ticket"])
+                self.server.changed.notify_all()
+            self._reply(201, {"ticket": entry["ticket"], "position": position})
+            return
+        with self.server.mutex:
+            self.server.requests += 1
+            if self.path in self.server.locks:
+                self._reply(400, {"detail": "lock already acquired"})
+                return
+            entries = self.server.queues.get(self.path)
+            if entries:
+                if entries[0]["acquired_by"] != body.get("acquired_by"):
+                    self._reply(400, {"detail": "lock is queued for another host"})
+                    return
+                entries.pop(0)
+                self.server.changed.notify_all()
+            self.server.locks[self.path] = {"acquired_by": body.get("acquired_by")}
+            self.server.acquired.append(body.get("acquired_by"))
+        self._reply(201, self.server.locks[self.path])
+
+    def do_DELETE(self):
+        queue = self._queue()
+        if self._unknown(queue):
+            return
+        with self.server.changed:
+            if queue:
+                lock, ticket, _ = queue
+                entries = self.server.queues.get(lock, [])
+                entries[:] = [entry for entry in entries if entry["ticket"] != ticket]
+            else:
+                self.server.locks.pop(self.path, None)
+            self.server.changed.notify_all()
+        self._reply(200, {})
+
+
+class LockServer:
+    """
+    in process stand-in for the dlm engine lock api. with queue, it also
+    serves the queue extension: POST queues/<name> enqueues with a priority,
+    GET queues/<name>/<ticket>?wait=&position= answers once the position
+    differs from the given one, the head is answered once the lock is free,
+    DELETE leaves the queue. only the head of a non empty queue can acquire.
+    """
+
+    def __init__(self, queue=False, ticket_ttl=120):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), LockHandler)
+        self._server.locks = dict()
+        self._server.mutex = threading.Lock()
+        self._server.changed = threading.Condition(self._server.mutex)
+        self._server.requests = 0
+        self._server.queue = queue
+        self._server.queues = dict()
+        self._server.tickets = 0
+        self._server.ticket_ttl = ticket_ttl
+        self._server.acquired = list()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    @property
+    def acquired(self):
+        """acquired_by of every successful acquisition, in order"""
+        return self._server.acquired
+
+    def queued(self, name):
+        """number of tickets in the queue of lock name"""
+        with self._server.mutex:
+            return len(self._server.queues.get(f"/locks/{name}", []))
+
+    def expire(self, name):
+        """drop the tickets of lock name, like the api does for waiters that stopped watching"""
+        with self._server.changed:
+            self._server.queues.pop(f"/locks/{name}", None)
+            self._server.changed.notify_all()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
@@ -0,0 +1,381 @@
+"""
+offline benchmark suite for the updater hot paths.
+
+every benchmark runs in its own interpreter against a synthetic script tree
+in a temporary directory, so peak rss is measured per benchmark. results are
+compared with the stored baseline. every benchmark runs --repeat times and
+the median of each metric is compared, a benchmark regresses if a median is
+worse than the baseline by more than the threshold.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --bench logger --bench discovery
+    python benchmarks/run.py --update_baseline
+
+metrics ending in _per_s are better when higher, all others, durations, sizes
+and counts like lock requests per run, are better when lower.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+
+def _updater(cfg):
+    from dlm_engine_updater.updater import DlmEngineUpdater
+
+    return DlmEngineUpdater(
+        cfg=cfg, after_reboot=False, date_constraint=None, random_sleep=0
+    )
+
+
+def bench_logger(basedir, scale):
+    """per line logging through DlmLogger with 20 plugins"""
+    from common import add_plugins
+    from common import percentile
+    from common import write_config
+
+    updater = _updater(write_config(basedir))
+    add_plugins(updater.plugin_manager, 20)
+    lines = 50000 * scale
+    latencies = list()
+    start = time.perf_counter()
+    for number in range(lines):
+        _start = time.perf_counter()
+        updater.log.info(f"bench line {number}", phase="update", script="bench")
+        latencies.append(time.perf_counter() - _start)
+    duration = time.perf_counter() - start
+    return {
+        "lines_per_s": lines / duration,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def bench_execute_shell(basedir, scale):
+    """output streaming of a huge and noisy script with 10 plugins"""
+    from common import add_plugins
+    from common import write_config
+    from common import write_script
+
+    updater = _updater(write_config(basedir))
+    add_plugins(updater.plugin_manager, 10)
+    lines = 100000 * scale
+    script = os.path.join(basedir, "noisy")
+    write_script(
+        script,
+        f"seq 1 {lines} | sed 's/$/ some noisy package manager output line/'",
+    )
+    start = time.perf_counter()
+    updater.execute_shell(
+        [script], user=updater.user_root.pw_name, phase="update", script=script
+    )
+    duration = time.perf_counter() - start
+    return {
+        "lines_per_s": lines / duration,
+        "script_ms": duration * 1000,
+    }
+
+
+def bench_discovery(basedir, scale):
+    """_get_scripts discovery over a big script tree and many fake users"""
+    from common import fake_users
+    from common import percentile
+    from common import script_tree
+    from common import write_config
+
+    updater = _updater(write_config(basedir))
+    script_tree(basedir, scripts_per_phase=500 * scale)
+    updater._user_scripts_users = fake_users(basedir, 50, 10 * scale)
+    latencies = list()
+    found = 0
+    # enough samples that the p95 is not the slowest one
+    for _ in range(100):
+        start = time.perf_counter()
+        found = len(
+            updater.get_scripts("pre_update.d", phase="pre_update", skip_user_scripts=False)
+        )
+        latencies.append(time.perf_counter() - start)
+    return {
+        "scripts_per_s": found / percentile(latencies, 50),
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+    }
+
+
+def bench_work(basedir, scale):
+    """full work() state machine against the local lock stand-in"""
+    from common import LockServer
+    from common import add_plugins
+    from common import percentile
+    from common import script_tree
+    from common import write_config
+
+    runs = 10 * scale
+    with LockServer() as server:
+        updater = _updater(write_config(basedir, endpoint=server.endpoint, noop=False))
+        add_plugins(updater.plugin_manager, 5)
+        script_tree(
+            basedir,
+            scripts_per_phase=10,
+            body="echo running; exit 0",
+            overrides={"needs_update.d": "exit 100", "ext_notify.d": "exit 0"},
+        )
+        latencies = list()
+        for _ in range(runs):
+            start = time.perf_counter()
+            try:
+                updater.run()
+            except SystemExit as err:
+                if err.code:
+                    raise RuntimeError(f"update run failed with {err.code}")
+            latencies.append(time.perf_counter() - start)
+            updater.reset()
+        requests = server.requests
+    return {
+        "runs_per_s": runs / sum(latencies),
+        "run_p50_ms": percentile(latencies, 50) * 1000,
+        "run_p95_ms": percentile(latencies, 95) * 1000,
+        "lock_requests_per_run": requests / runs,
+    }
+
+
+def _until(predicate, timeout=30):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            raise RuntimeError("timed out waiting for the lock stand-in")
+        time.sleep(0.01)
+
+
+def _queued_updater(basedir, endpoint, priority):
+    """updater waiting in the lock queue with priority, acquires as p<priority>"""
+    from common import bench_lock
+    from common import write_config
+
+    os.makedirs(basedir)
+    cfg = write_config(
+        basedir,
+        endpoint=endpoint,
+        noop=False,
+        extra=[
+            "main_wait=true",
+            "main_lock_queue=true",
+            f"main_lock_priority={priority}",
+            "main_lock_queuepoll=5",
+        ],
+    )
+    updater = _updater(cfg)
+    bench_lock(updater, f"p{priority}")
+    return updater
+
+
+def bench_queue(basedir, scale):
+    """
+    lock handoff through the queue extension: updaters with different
+    priorities wait for a held lock and must acquire in priority order,
+    also after their tickets expired. without the extension they fall back
+    to polling.
+    """
+    import threading
+
+    from common import LockServer
+    from common import bench_lock
+    from common import percentile
+    from common import write_config
+
+    # lower classes are served first, they enqueue last
+    priorities = [90, 70, 50, 30, 10]
+    rounds = 3 * scale
+    handoffs = list()
+    with LockServer(queue=True, ticket_ttl=5) as server:
+        updaters = [
+            _queued_updater(os.path.join(basedir, f"p{priority}"), server.endpoint, priority)
+            for priority in priorities
+        ]
+        holder = _updater(write_config(basedir, endpoint=server.endpoint, noop=False))
+        holder = bench_lock(holder, "holder")
+        lock_name = holder.lock_name
+        for _ in range(rounds):
+            del server.acquired[:]
+            acquired = dict()
+            released = dict()
+            if not holder.acquire():
+                raise RuntimeError("holder could not acquire the lock")
+
+            def waiter(updater):
+                try:
+                    updater.dlm_lock_get()
+                except SystemExit as err:
+                    raise RuntimeError(f"lock_get exited with {err.code}")
+                acquired[updater] = time.monotonic()
+                time.sleep(0.05)
+                released[updater] = time.monotonic()
+                updater.dlm_lock_release()
+
+            threads = list()
+            for number, updater in enumerate(updaters):
+                thread = threading.Thread(target=waiter, args=(updater,), daemon=True)
+                thread.start()
+                threads.append(thread)
+                _until(lambda: server.queued(lock_name) == number + 1)
+            # every waiter has to notice and enqueue again
+            server.expire(lock_name)
+            _until(lambda: server.queued(lock_name) == len(updaters))
+            released[holder] = time.monotonic()
+            holder.release()
+            for thread in threads:
+                thread.join(60)
+            order = ["holder"] + [f"p{priority}" for priority in sorted(priorities)]
+            if server.acquired != order:
+                raise RuntimeError(f"acquired in order {server.acquired}, expected {order}")
+            previous = holder
+            for updater in sorted(acquired, key=acquired.get):
+                handoffs.append(acquired[updater] - released[previous])
+                previous = updater
+        requests = server.requests
+
+    # an api without the queue extension, the waiter has to poll
+    with LockServer(queue=False) as server:
+        holder = _updater(write_config(basedir, endpoint=server.endpoint, noop=False))
+        holder = bench_lock(holder, "holder")
+        holder.acquire()
+        updater = _queued_updater(os.path.join(basedir, "fallback"), server.endpoint, 50)
+        if updater.dlm_lock._acquire_queue() is not None:
+            raise RuntimeError("waiter did not fall back to polling without the queue extension")
+        holder.release()
+    return {
+        "handoff_p50_ms": percentile(handoffs, 50) * 1000,
+        "handoff_p95_ms": percentile(handoffs, 95) * 1000,
+        "lock_requests_per_acquire": requests / (rounds * (len(priorities) + 1)),
+    }
+
+
+BENCHMARKS = {
+    "logger": bench_logger,
+    "execute_shell": bench_execute_shell,
+    "discovery": bench_discovery,
+    "work": bench_work,
+    "queue": bench_queue,
+}
+
+
+def single(name, scale):
+    from common import peak_rss_kb
+
+    with tempfile.TemporaryDirectory() as basedir:
+        result = BENCHMARKS[name](basedir, scale)
+    result["peak_rss_kb"] = peak_rss_kb()
+    print(json.dumps(result))
+
+
+def run_single(name, scale, env):
+    """result of benchmark name in its own interpreter, None if it failed"""
+    proc = subprocess.run(
+        [sys.executable, __file__, "--single", name, "--scale", str(scale)],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=False,
+    )
+    if proc.returncode != 0:
+        print(f"{name}: exit code {proc.returncode}")
+        return None
+    return json.loads(proc.stdout.decode().strip().splitlines()[-1])
+
+
+def median(results):
+    """median of every metric over the results of repeated runs"""
+    from common import percentile
+
+    return {
+        metric: percentile([result[metric] for result in results], 50)
+        for metric in results[0]
+    }
+
+
+def regressions(name, result, baseline, threshold):
+    found = list()
+    for metric, value in result.items():
+        base = baseline.get(name, {}).get(metric)
+        if not base:
+            continue
+        if metric.endswith("_per_s"):
+            change = (base - value) / base
+        else:
+            change = (value - base) / base
+        if change > threshold:
+            found.append(f"{metric} {value:.2f} vs baseline {base:.2f} ({change:+.0%})")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dlm engine updater benchmarks")
+    parser.add_argument("--bench", action="append", choices=sorted(BENCHMARKS))
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--update_baseline", action="store_true", default=False)
+    parser.add_argument("--single", choices=sorted(BENCHMARKS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        single(args.single, args.scale)
+        return
+
+    try:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        baseline = dict()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [REPO, os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+    )
+    results = dict()
+    failed = list()
+    for name in args.bench or sorted(BENCHMARKS):
+        runs = list()
+        for _ in range(max(1, args.repeat)):
+            result = run_single(name, args.scale, env)
+            if result is None:
+                break
+            runs.append(result)
+        if result is None:
+            print(f"{name}: FAILED")
+            failed.append(name)
+            continue
+        # the median of a few runs, the tail metrics of a single run follow single outliers
+        result = median(runs)
+        results[name] = result
+        print(name)
+        for metric, value in sorted(result.items()):
+            base = baseline.get(name, {}).get(metric)
+            base = f"(baseline {base:.2f})" if base else ""
+            print(f"  {metric:24} {value:14.2f} {base}")
+        for regression in regressions(name, result, baseline, args.threshold):
+            print(f"  REGRESSION {regression}")
+            failed.append(name)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
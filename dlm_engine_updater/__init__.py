@@ -1,6 +1,110 @@
 import argparse
+import sys
 
-from dlm_engine_updater.updater import DlmEngineUpdater
+from dlm_engine_updater.constraint import DlmEngineCalendar
+from dlm_engine_updater.constraint import DlmEngineConstraintError
+from dlm_engine_updater.startup import fast_exit
+from dlm_engine_updater.startup import peek_basedir
+from dlm_engine_updater.startup import peek_domains
+from dlm_engine_updater.startup import peek_setting
+from dlm_engine_updater.startup import DEFAULT_LOG_FILE
+
+
+def next_window(parsed_args):
+    try:
+        constraints = DlmEngineCalendar.from_args(
+            date_constraint=parsed_args.date_constraint,
+            calendar=parsed_args.calendar,
+            blackout=parsed_args.blackout,
+            timezone=parsed_args.timezone,
+        )
+    except DlmEngineConstraintError as err:
+        print(f"Invalid date constraint: {err}")
+        sys.exit(1)
+    window = constraints.next_window()
+    if window is None:
+        print("no allowed window found")
+        sys.exit(1)
+    start, end = window
+    print(f"{start.isoformat()} {end.isoformat() if end else 'open'}")
+    sys.exit(0)
+
+
+def history(parsed_args):
+    # sqlite only, the configuration, plugins and http client are not needed to read the history
+    from dlm_engine_updater.history import report
+
+    basedir = peek_basedir(parsed_args.cfg)
+    if parsed_args.domain:
+        domains = peek_domains(parsed_args.cfg)
+        if parsed_args.domain not in domains:
+            print(f"unknown update domain {parsed_args.domain}")
+            sys.exit(1)
+        basedir = domains[parsed_args.domain]
+    sys.exit(
+        report(
+            f"{basedir}/history.db",
+            runs=parsed_args.runs,
+            top=parsed_args.top,
+        )
+    )
+
+
+def logs(parsed_args):
+    # reads the index and seeks into the log files, like history nothing heavy is imported
+    from dlm_engine_updater.logindex import show
+
+    basedir = peek_basedir(parsed_args.cfg)
+    if parsed_args.domain:
+        domains = peek_domains(parsed_args.cfg)
+        if parsed_args.domain not in domains:
+            print(f"unknown update domain {parsed_args.domain}")
+            sys.exit(1)
+        basedir = domains[parsed_args.domain]
+    sys.exit(
+        show(
+            peek_setting(parsed_args.cfg, "main_log_file", DEFAULT_LOG_FILE),
+            history=f"{basedir}/history.db",
+            run_id=parsed_args.run,
+            last=parsed_args.last,
+            outcome=parsed_args.outcome,
+            phase=parsed_args.phase,
+            script=parsed_args.script,
+            domain=parsed_args.domain,
+            list_runs=parsed_args.list,
+        )
+    )
+
+
+def fleet_report(parsed_args):
+    # sqlite and json only, like history, the configuration is not read
+    from dlm_engine_updater.fleet import report
+
+    sys.exit(
+        report(
+            parsed_args.paths,
+            since=parsed_args.since,
+            until=parsed_args.until,
+            bin_size=parsed_args.bin,
+            top=parsed_args.top,
+            jobs=parsed_args.jobs,
+        )
+    )
+
+
+def status(parsed_args):
+    # standard library only, the status has to be quick even while an update is running
+    import json
+
+    from dlm_engine_updater.status import status as _status
+
+    domains = peek_domains(parsed_args.cfg)
+    if domains:
+        result = {name: _status(basedir) for name, basedir in domains.items()}
+    else:
+        result = _status(peek_basedir(parsed_args.cfg))
+    print(json.dumps(result, indent=2))
+    sys.exit(0)
 
 
 def main():
@@ -32,6 +136,65 @@ def main():
         "would only run if this is the 3rd Friday of a month.",
     )
 
+    parser.add_argument(
+        "--calendar",
+        dest="calendar",
+        action="append",
+        default=None,
+        help="exit if now does not match the cron like expression "
+        "'minute hour day_of_month month day_of_week'. "
+        "day of week also accepts week of month rules, like Fri#3 or Sun#L. "
+        "can be used multiple times, any matching expression allows the run.",
+    )
+
+    parser.add_argument(
+        "--blackout",
+        dest="blackout",
+        action="append",
+        default=None,
+        help="exit if now is inside the blackout range START..END, "
+        "example value: 2026-12-20..2027-01-06 or 2026-10-20T18:00..2026-10-21T06:00. "
+        "can be used multiple times.",
+    )
+
+    parser.add_argument(
+        "--timezone",
+        dest="timezone",
+        action="store",
+        default=None,
+        help="timezone used to evaluate date constraints, calendar expressions and blackouts, "
+        "defaults to the local timezone.",
+    )
+
+    parser.add_argument(
+        "--next_window",
+        "--next-window",
+        dest="next_window",
+        action="store_true",
+        default=False,
+        help="print start and end of the next allowed window and exit.",
+    )
+
+    parser.add_argument(
+        "--status",
+        dest="status",
+        action="store_true",
+        default=False,
+        help="print the phase, script and lock state of the running updater as JSON and exit, with recent "
+        "script output if main_status_lines is set. falls back to the state file if no updater is running.",
+    )
+
+    parser.add_argument(
+        "--deadline",
+        dest="deadline",
+        action="store",
+        default=None,
+        help="do not acquire the lock if the update is not expected to finish before the deadline, "
+        "an ISO date and time or the next occurrence of HH:MM. "
+        "the end of the window allowed by the date constraints is a deadline too, "
+        "without --deadline only with main_deadline_window=true.",
+    )
+
     parser.add_argument(
         "--random_sleep",
         dest="random_sleep",
@@ -42,13 +205,248 @@ def main():
         help="add random sleep before acutally doing something",
     )
 
+    parser.add_argument(
+        "--rerun",
+        dest="rerun",
+        action="store_true",
+        default=False,
+        help="ignore script checkpoints of a previous failed run and re-run every script of the current phase.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store",
+        nargs="?",
+        const="deterministic",
+        default=None,
+        choices=["deterministic", "sampling"],
+        help="profile every phase and write the profiles to main_profile_dir. "
+        "deterministic uses cProfile, sampling records stacks with low overhead.",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        dest="daemon",
+        action="store_true",
+        default=False,
+        help="keep running and schedule update cycles internally, reload configuration on SIGHUP. "
+        "update domains are not supported in daemon mode.",
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    history_parser = subparsers.add_parser(
+        "history",
+        help="print duration percentiles and the slowest scripts of the recorded runs and exit.",
+    )
+    history_parser.add_argument(
+        "--runs",
+        dest="runs",
+        action="store",
+        default=100,
+        type=int,
+        help="number of most recent runs to summarize.",
+    )
+    history_parser.add_argument(
+        "--domain",
+        dest="domain",
+        action="store",
+        default=None,
+        help="summarize the runs of this update domain.",
+    )
+    history_parser.add_argument(
+        "--top",
+        dest="top",
+        action="store",
+        default=10,
+        type=int,
+        help="number of slowest scripts to list.",
+    )
+
+    logs_parser = subparsers.add_parser(
+        "logs",
+        help="print the log of a run, or of one of its phases or scripts, using the log index and exit.",
+    )
+    logs_parser.add_argument(
+        "--run",
+        dest="run",
+        action="store",
+        default=None,
+        help="run id or a prefix of it, see --list.",
+    )
+    logs_parser.add_argument(
+        "--last",
+        dest="last",
+        action="store",
+        default=1,
+        type=int,
+        help="the n-th most recent matching run, 1 is the most recent one.",
+    )
+    logs_parser.add_argument(
+        "--outcome",
+        dest="outcome",
+        action="store",
+        default=None,
+        help="only runs with this outcome in the run history, like failed.",
+    )
+    logs_parser.add_argument(
+        "--phase",
+        dest="phase",
+        action="store",
+        default=None,
+        help="only the log of this phase.",
+    )
+    logs_parser.add_argument(
+        "--script",
+        dest="script",
+        action="store",
+        default=None,
+        help="only the log of scripts whose path contains this.",
+    )
+    logs_parser.add_argument(
+        "--domain",
+        dest="domain",
+        action="store",
+        default=None,
+        help="only the log of this update domain.",
+    )
+    logs_parser.add_argument(
+        "--list",
+        dest="list",
+        action="store_true",
+        default=False,
+        help="list the matching runs with time range, outcome, size and phases instead.",
+    )
+
+    report_parser = subparsers.add_parser(
+        "report",
+        help="summarize run histories and trace files collected from many hosts and exit.",
+    )
+    report_parser.add_argument(
+        "paths",
+        nargs="+",
+        help="history.db files, OTLP JSON lines trace files (optionally gzip compressed) "
+        "or directories that are searched for them.",
+    )
+    report_parser.add_argument(
+        "--since",
+        dest="since",
+        action="store",
+        default=None,
+        help="only runs started at or after this time, epoch seconds or ISO date and time, UTC if no offset is given.",
+    )
+    report_parser.add_argument(
+        "--until",
+        dest="until",
+        action="store",
+        default=None,
+        help="only runs started before this time.",
+    )
+    report_parser.add_argument(
+        "--bin",
+        dest="bin",
+        action="store",
+        default=300,
+        type=int,
+        help="seconds per row of the lock contention timeline.",
+    )
+    report_parser.add_argument(
+        "--top",
+        dest="top",
+        action="store",
+        default=10,
+        type=int,
+        help="number of slowest scripts, contended locks and failure clusters to list.",
+    )
+    report_parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        action="store",
+        default=None,
+        type=int,
+        help="worker processes, defaults to the number of CPUs.",
+    )
+
     parsed_args = parser.parse_args()
 
+    if parsed_args.command == "history":
+        history(parsed_args)
+
+    if parsed_args.command == "report":
+        fleet_report(parsed_args)
+
+    if parsed_args.command == "logs":
+        logs(parsed_args)
+
+    if parsed_args.status:
+        status(parsed_args)
+
+    if parsed_args.next_window:
+        next_window(parsed_args)
+
+    domains = peek_domains(parsed_args.cfg)
+
+    if parsed_args.daemon:
+        if domains:
+            print("update domains are not supported in daemon mode")
+            sys.exit(1)
+        from dlm_engine_updater.daemon import DlmEngineUpdaterDaemon
+
+        instance = DlmEngineUpdaterDaemon(
+            cfg=parsed_args.cfg,
+            date_constraint=parsed_args.date_constraint,
+            random_sleep=parsed_args.random_sleep,
+            rerun=parsed_args.rerun,
+            calendar=parsed_args.calendar,
+            blackout=parsed_args.blackout,
+            timezone=parsed_args.timezone,
+            profile=parsed_args.profile,
+            deadline=parsed_args.deadline,
+        )
+        instance.work()
+        return
+
+    fast_exit(
+        cfg=parsed_args.cfg,
+        after_reboot=parsed_args.rbt,
+        date_constraint=parsed_args.date_constraint,
+        calendar=parsed_args.calendar,
+        blackout=parsed_args.blackout,
+        timezone=parsed_args.timezone,
+    )
+
+    if domains:
+        from dlm_engine_updater.domains import DlmEngineDomains
+
+        instance = DlmEngineDomains(
+            cfg=parsed_args.cfg,
+            after_reboot=parsed_args.rbt,
+            date_constraint=parsed_args.date_constraint,
+            random_sleep=parsed_args.random_sleep,
+            rerun=parsed_args.rerun,
+            calendar=parsed_args.calendar,
+            blackout=parsed_args.blackout,
+            timezone=parsed_args.timezone,
+            profile=parsed_args.profile,
+            deadline=parsed_args.deadline,
+        )
+        instance.work()
+        return
+
+    # imported late, pydantic, httpx and the plugins are only needed past the fast exit checks
+    from dlm_engine_updater.updater import DlmEngineUpdater
+
     instance = DlmEngineUpdater(
         cfg=parsed_args.cfg,
         after_reboot=parsed_args.rbt,
         date_constraint=parsed_args.date_constraint,
         random_sleep=parsed_args.random_sleep,
+        rerun=parsed_args.rerun,
+        calendar=parsed_args.calendar,
+        blackout=parsed_args.blackout,
+        timezone=parsed_args.timezone,
+        profile=parsed_args.profile,
+        deadline=parsed_args.deadline,
     )
     instance.work()
 
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+from dlm_engine_updater.logger import DlmLogger
+
+
+class DlmEngineNeedsUpdateCache:
+    def __init__(
+        self,
+        log,
+        path,
+        ttl,
+        fingerprint_cmd=None,
+        fingerprint_files=None,
+    ):
+        self._log = log
+        self._path = path
+        self._ttl = ttl
+        self._fingerprint_cmd = fingerprint_cmd
+        self._fingerprint_files = fingerprint_files or list()
+        self._fingerprint = None
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    @property
+    def fingerprint_cmd(self):
+        return self._fingerprint_cmd
+
+    @property
+    def fingerprint_files(self):
+        return self._fingerprint_files
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = self._get_fingerprint()
+        return self._fingerprint
+
+    def reset(self):
+        self._fingerprint = None
+
+    def _get_fingerprint(self):
+        sha256 = hashlib.sha256()
+        for _file in self.fingerprint_files:
+            try:
+                _stat = os.stat(_file)
+                sha256.update(f"{_file}:{_stat.st_mtime_ns}:{_stat.st_size}\n".encode())
+            except FileNotFoundError:
+                sha256.update(f"{_file}:missing\n".encode())
+            except OSError as err:
+                self.log.warning(
+                    f"could not stat fingerprint file {_file}: {err}",
+                    phase="needs_update",
+                )
+                return ""
+        if self.fingerprint_cmd:
+            try:
+                result = subprocess.run(
+                    self.fingerprint_cmd,
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    timeout=60,
+                )
+            except (OSError, subprocess.TimeoutExpired) as err:
+                self.log.warning(
+                    f"fingerprint command failed: {err}", phase="needs_update"
+                )
+                return ""
+            if result.returncode != 0:
+                self.log.warning(
+                    f"fingerprint command returned {result.returncode}",
+                    phase="needs_update",
+                )
+                return ""
+            sha256.update(result.stdout)
+        return sha256.hexdigest()
+
+    def get(self):
+        try:
+            with open(self.path, "r") as cache:
+                entry = json.load(cache)
+        except FileNotFoundError:
+            self.log.debug("needs_update cache is empty", phase="needs_update")
+            return None
+        except (OSError, ValueError) as err:
+            self.log.warning(
+                f"could not read needs_update cache: {err}", phase="needs_update"
+            )
+            return None
+        age = time.time() - entry.get("timestamp", 0)
+        if age < 0 or age > self.ttl:
+            self.log.info(
+                f"needs_update cache expired, age {int(age)} seconds",
+                phase="needs_update",
+            )
+            return None
+        if not self.fingerprint:
+            self.log.info(
+                "no usable fingerprint, ignoring needs_update cache",
+                phase="needs_update",
+            )
+            return None
+        if entry.get("fingerprint") != self.fingerprint:
+            self.log.info("needs_update fingerprint changed", phase="needs_update")
+            return None
+        self.log.info(
+            f"using cached needs_update verdict from {int(age)} seconds ago",
+            phase="needs_update",
+        )
+        return bool(entry.get("update"))
+
+    def set(self, update):
+        # the checks themselves may refresh repository metadata
+        self.reset()
+        if not self.fingerprint:
+            return
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as cache:
+                json.dump(
+                    {
+                        "timestamp": time.time(),
+                        "fingerprint": self.fingerprint,
+                        "update": update,
+                    },
+                    cache,
+                )
+            os.replace(tmp, self.path)
+        except OSError as err:
+            self.log.warning(
+                f"could not write needs_update cache: {err}", phase="needs_update"
+            )
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            self.log.warning(f"could not remove needs_update cache: {err}")
@@ -20,6 +20,7 @@ class DlmUpdaterConfigMainLog(BaseModel):
     level: str = "DEBUG"
     retention: typing.Optional[int] = 7
     file: typing.Optional[str] = "/var/log/dlm_engine_updater/dlm_engine_updater.log"
+    index: typing.Optional[bool] = True
 
 
 class DlmUpdaterConfigMainPlugin(BaseModel):
@@ -27,9 +28,109 @@ class DlmUpdaterConfigMainPlugin(BaseModel):
     config: typing.Optional[dict[str, str]] = None
 
 
+class DlmUpdaterConfigMainCache(BaseModel):
+    enabled: typing.Optional[bool] = False
+    ttl: typing.Optional[int] = 21600
+    fingerprintcmd: typing.Optional[str] = None
+    fingerprintfiles: typing.Optional[typing.List[str]] = None
+
+
+class DlmUpdaterConfigMainDaemon(BaseModel):
+    interval: typing.Optional[int] = 3600
+
+
+class DlmUpdaterConfigMainMetrics(BaseModel):
+    dir: typing.Optional[str] = None
+
+
+class DlmUpdaterConfigMainTrace(BaseModel):
+    file: typing.Optional[str] = None
+
+
+class DlmUpdaterConfigMainHistory(BaseModel):
+    enabled: typing.Optional[bool] = True
+    retention: typing.Optional[int] = 90
+    maxruns: typing.Optional[int] = 1000
+
+
+class DlmUpdaterConfigMainCgroup(BaseModel):
+    enabled: typing.Optional[bool] = False
+    path: typing.Optional[str] = "/sys/fs/cgroup/dlm_engine_updater"
+    cpuweight: typing.Optional[int] = None
+    memorymax: typing.Optional[str] = None
+    ioweight: typing.Optional[int] = None
+
+
+class DlmUpdaterConfigMainGuard(BaseModel):
+    wait: typing.Optional[int] = 0
+
+
+class DlmUpdaterConfigMainSlot(BaseModel):
+    enabled: typing.Optional[bool] = False
+    jitter: typing.Optional[int] = 0
+    identity: typing.Optional[str] = None
+
+
+class DlmUpdaterConfigMainStatus(BaseModel):
+    enabled: typing.Optional[bool] = True
+    mode: typing.Optional[str] = "0660"
+    # lines of script output served, none by default
+    lines: typing.Optional[int] = 0
+
+
+class DlmUpdaterConfigMainLock(BaseModel):
+    speculative: typing.Optional[bool] = False
+    queue: typing.Optional[bool] = False
+    # lower classes are served first, first come first served within a class
+    priority: typing.Optional[int] = 50
+    queuepoll: typing.Optional[int] = 30
+
+
+class DlmUpdaterConfigMainDeadline(BaseModel):
+    # the end of the date constraint window is a deadline without --deadline too
+    window: typing.Optional[bool] = False
+    margin: typing.Optional[int] = 300
+    percentile: typing.Optional[int] = 90
+    runs: typing.Optional[int] = 20
+
+
+class DlmUpdaterConfigMainProfile(BaseModel):
+    enabled: typing.Optional[bool] = False
+    mode: typing.Optional[str] = "deterministic"
+    dir: typing.Optional[str] = "/var/log/dlm_engine_updater/profile"
+    top: typing.Optional[int] = 10
+    interval: typing.Optional[float] = 0.01
+
+
+class DlmUpdaterConfigMainPostRelease(BaseModel):
+    failure: typing.Optional[typing.Literal["stop", "ignore"]] = "stop"
+
+
+class DlmUpdaterConfigDomain(BaseModel):
+    enabled: typing.Optional[bool] = True
+    lockname: typing.Optional[str] = None
+    basedir: typing.Optional[str] = None
+    conflicts: typing.Optional[typing.List[str]] = None
+
+
 class DlmUpdaterConfigMain(BaseModel):
     api: typing.Optional[DLMEngineUpdaterMainApi] = DLMEngineUpdaterMainApi()
     log: typing.Optional[DlmUpdaterConfigMainLog] = DlmUpdaterConfigMainLog()
+    cache: typing.Optional[DlmUpdaterConfigMainCache] = DlmUpdaterConfigMainCache()
+    daemon: typing.Optional[DlmUpdaterConfigMainDaemon] = DlmUpdaterConfigMainDaemon()
+    metrics: typing.Optional[DlmUpdaterConfigMainMetrics] = DlmUpdaterConfigMainMetrics()
+    trace: typing.Optional[DlmUpdaterConfigMainTrace] = DlmUpdaterConfigMainTrace()
+    profile: typing.Optional[DlmUpdaterConfigMainProfile] = DlmUpdaterConfigMainProfile()
+    history: typing.Optional[DlmUpdaterConfigMainHistory] = DlmUpdaterConfigMainHistory()
+    deadline: typing.Optional[DlmUpdaterConfigMainDeadline] = DlmUpdaterConfigMainDeadline()
+    lock: typing.Optional[DlmUpdaterConfigMainLock] = DlmUpdaterConfigMainLock()
+    cgroup: typing.Optional[DlmUpdaterConfigMainCgroup] = DlmUpdaterConfigMainCgroup()
+    status: typing.Optional[DlmUpdaterConfigMainStatus] = DlmUpdaterConfigMainStatus()
+    slot: typing.Optional[DlmUpdaterConfigMainSlot] = DlmUpdaterConfigMainSlot()
+    guard: typing.Optional[DlmUpdaterConfigMainGuard] = DlmUpdaterConfigMainGuard()
+    postrelease: typing.Optional[
+        DlmUpdaterConfigMainPostRelease
+    ] = DlmUpdaterConfigMainPostRelease()
     basedir: typing.Optional[str] = "/etc/dlm_engine_updater"
     wait: typing.Optional[bool] = False
     waitmax: typing.Optional[int] = 3600
@@ -42,6 +143,7 @@ class DlmUpdaterConfig(BaseSettings):
     )
     main: DlmUpdaterConfigMain = DlmUpdaterConfigMain()
     plugin: typing.Optional[dict[str, DlmUpdaterConfigMainPlugin]] = None
+    domain: typing.Optional[dict[str, DlmUpdaterConfigDomain]] = None
 
     @model_validator(mode="after")
     @classmethod
@@ -59,6 +161,14 @@ class DlmUpdaterConfig(BaseSettings):
         if not values.main.api.secret:
             print("main_api_secret is required")
             errors = True
+        for name, domain in (values.domain or {}).items():
+            if not domain.lockname:
+                print(f"domain_{name}_lockName is required")
+                errors = True
+            for conflict in domain.conflicts or []:
+                if conflict not in values.domain:
+                    print(f"domain_{name}_conflicts: unknown domain {conflict}")
+                    errors = True
         if errors:
             sys.exit(1)
         return values
@@ -0,0 +1,517 @@
+import calendar
+import datetime
+import hashlib
+import random
+import time
+
+MONTHS = {
+    name.lower(): number
+    for number, name in enumerate(calendar.month_abbr)
+    if name
+}
+# cron numbering, 0 and 7 are Sunday
+WEEKDAYS = {
+    "sun": 0,
+    "mon": 1,
+    "tue": 2,
+    "wed": 3,
+    "thu": 4,
+    "fri": 5,
+    "sat": 6,
+}
+LEGACY_WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+MINUTE = datetime.timedelta(minutes=1)
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+# long enough for every expression that can match at all, including Feb 29
+HORIZON_MONTHS = 12 * 9
+
+
+class DlmEngineConstraintError(Exception):
+    pass
+
+
+def slot(identity, lock_name, window, spread, jitter=0):
+    """
+    offset in seconds of a host within spread. the offset is derived from a
+    hash of the host identity, the lock name and the window, so every host
+    keeps its offset within a window and hosts are spread uniformly without
+    coordination. jitter adds up to that many seconds in either direction.
+    """
+    digest = hashlib.sha256(f"{identity}\0{lock_name}\0{window}".encode()).digest()
+    offset = int.from_bytes(digest[:8], "big") / 2**64 * spread
+    if jitter:
+        offset += random.uniform(-jitter, jitter)
+    return min(max(offset, 0.0), spread)
+
+
+def _cron_weekday(cron_weekday):
+    # cron 0=Sunday, python 0=Monday
+    return (cron_weekday - 1) % 7
+
+
+def _parse_value(value, names, minimum, maximum):
+    value = value.strip().lower()
+    if value in names:
+        return names[value]
+    try:
+        number = int(value)
+    except ValueError:
+        raise DlmEngineConstraintError(f"invalid value {value}")
+    if number < minimum or number > maximum:
+        raise DlmEngineConstraintError(
+            f"value {number} out of range {minimum}-{maximum}"
+        )
+    return number
+
+
+def _parse_field(field, minimum, maximum, names=None):
+    names = names or dict()
+    values = set()
+    for item in field.split(","):
+        step = 1
+        if "/" in item:
+            item, _step = item.split("/", 1)
+            try:
+                step = int(_step)
+            except ValueError:
+                raise DlmEngineConstraintError(f"invalid step {_step}")
+            if step < 1:
+                raise DlmEngineConstraintError(f"invalid step {step}")
+        if item == "*":
+            start, end = minimum, maximum
+        elif "-" in item:
+            start, end = item.split("-", 1)
+            start = _parse_value(start, names, minimum, maximum)
+            end = _parse_value(end, names, minimum, maximum)
+            if end < start:
+                raise DlmEngineConstraintError(f"invalid range {item}")
+        else:
+            start = _parse_value(item, names, minimum, maximum)
+            end = maximum if step > 1 else start
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class DlmEngineCronRule:
+    """
+    cron like rule: "minute hour day_of_month month day_of_week"
+
+    every minute matching all fields is allowed. the day of week field also
+    accepts week of month rules: "Fri#3" is the 3rd Friday, "Sun#L" the last
+    Sunday of a month. if day of month and day of week are both restricted,
+    a day matches if either of them matches, like in cron.
+    """
+
+    def __init__(self, expression):
+        self._expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise DlmEngineConstraintError(
+                f"invalid expression {expression}, expected 5 fields"
+            )
+        minute, hour, dom, month, dow = fields
+        self._minutes = _parse_field(minute, 0, 59)
+        self._hours = _parse_field(hour, 0, 23)
+        self._dom_any = dom == "*"
+        self._dom = _parse_field(dom, 1, 31)
+        self._months = _parse_field(month, 1, 12, MONTHS)
+        self._dow_any = dow == "*"
+        self._dow = set()
+        self._dow_nth = set()
+        self._parse_dow(dow)
+        self._sorted_minutes = sorted(self._minutes)
+        self._sorted_hours = sorted(self._hours)
+
+    def _parse_dow(self, dow):
+        plain = list()
+        for item in dow.split(","):
+            if "#" not in item:
+                plain.append(item)
+                continue
+            day, nth = item.split("#", 1)
+            day = _cron_weekday(_parse_value(day, WEEKDAYS, 0, 7))
+            if nth.upper() == "L":
+                self._dow_nth.add((day, "L"))
+                continue
+            try:
+                nth = int(nth)
+            except ValueError:
+                raise DlmEngineConstraintError(f"invalid week of month {nth}")
+            if nth not in range(1, 6):
+                raise DlmEngineConstraintError(
+                    "week of month must be between 1 and 5 or L"
+                )
+            self._dow_nth.add((day, nth))
+        if plain:
+            for day in _parse_field(",".join(plain), 0, 7, WEEKDAYS):
+                self._dow.add(_cron_weekday(day))
+
+    @classmethod
+    def from_legacy(cls, constraint):
+        try:
+            nth, day = constraint.split(":", maxsplit=1)
+        except ValueError:
+            raise DlmEngineConstraintError(
+                "Invalid date constraint, must match NUM:DAY_ABBR"
+            )
+        try:
+            nth = int(nth)
+        except ValueError:
+            raise DlmEngineConstraintError(
+                "Invalid date constraint, number must be between 1 and 5"
+            )
+        if nth not in range(1, 6):
+            raise DlmEngineConstraintError(
+                "Invalid date constraint, number must be between 1 and 5"
+            )
+        if day not in LEGACY_WEEKDAYS:
+            raise DlmEngineConstraintError(
+                f"Invalid date constraint, day must be one of {LEGACY_WEEKDAYS}"
+            )
+        return cls(f"* * * * {day}#{nth}")
+
+    @property
+    def expression(self):
+        return self._expression
+
+    def days(self, year, month):
+        """sorted days of the month matching the rule"""
+        if month not in self._months:
+            return list()
+        first_weekday, ndays = calendar.monthrange(year, month)
+        dom = {day for day in self._dom if day <= ndays}
+        dow = set()
+        for weekday in self._dow:
+            dow.update(range(1 + (weekday - first_weekday) % 7, ndays + 1, 7))
+        for weekday, nth in self._dow_nth:
+            first = 1 + (weekday - first_weekday) % 7
+            if nth == "L":
+                dow.add(first + 7 * ((ndays - first) // 7))
+            elif first + 7 * (nth - 1) <= ndays:
+                dow.add(first + 7 * (nth - 1))
+        if self._dom_any and self._dow_any:
+            return list(range(1, ndays + 1))
+        if self._dom_any:
+            return sorted(dow)
+        if self._dow_any:
+            return sorted(dom)
+        return sorted(dom | dow)
+
+    def day_matches(self, date):
+        return date.day in self.days(date.year, date.month)
+
+    def matches(self, moment):
+        return (
+            moment.minute in self._minutes
+            and moment.hour in self._hours
+            and self.day_matches(moment)
+        )
+
+    def _first(self, values, minimum):
+        for value in values:
+            if value >= minimum:
+                return value
+        return None
+
+    def next_match(self, moment):
+        """first matching minute at or after moment, None if there is none"""
+        moment = moment.replace(second=0, microsecond=0)
+        year, month = moment.year, moment.month
+        for _ in range(HORIZON_MONTHS):
+            for day in self.days(year, month):
+                date = datetime.datetime(year, month, day)
+                if date.date() < moment.date():
+                    continue
+                hour_min, minute_min = 0, 0
+                if date.date() == moment.date():
+                    hour_min, minute_min = moment.hour, moment.minute
+                for hour in self._sorted_hours:
+                    if hour < hour_min:
+                        continue
+                    minute = self._first(
+                        self._sorted_minutes, minute_min if hour == hour_min else 0
+                    )
+                    if minute is not None:
+                        return date.replace(hour=hour, minute=minute)
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+        return None
+
+    def next_miss(self, moment, limit):
+        """first non matching minute at or after moment, at most limit"""
+        moment = moment.replace(second=0, microsecond=0)
+        while moment < limit:
+            if not self.day_matches(moment):
+                return moment
+            if len(self._hours) == 24 and len(self._minutes) == 60:
+                moment = datetime.datetime.combine(moment.date(), datetime.time()) + DAY
+                continue
+            if moment.hour not in self._hours or moment.minute not in self._minutes:
+                return moment
+            minute = moment.minute
+            while minute + 1 in self._minutes:
+                minute += 1
+            if minute < 59:
+                return moment.replace(minute=minute + 1)
+            moment = moment.replace(minute=0) + HOUR
+        return limit
+
+    def first_match(self, moment, limit):
+        """first minute of the matching minutes up to the matching moment, at least limit"""
+        moment = moment.replace(second=0, microsecond=0)
+        while moment > limit:
+            if len(self._hours) == 24 and len(self._minutes) == 60:
+                day = datetime.datetime.combine(moment.date(), datetime.time())
+                if day <= limit or not self.day_matches(day - DAY):
+                    return max(day, limit)
+                moment = day - MINUTE
+                continue
+            minute = moment.minute
+            while minute - 1 in self._minutes:
+                minute -= 1
+            hour = moment.replace(minute=0)
+            if minute > 0 or not self.matches(hour - MINUTE):
+                return max(moment.replace(minute=minute), limit)
+            moment = hour - MINUTE
+        return limit
+
+
+class DlmEngineBlackout:
+    def __init__(self, blackout):
+        self._blackout = blackout
+        try:
+            start, end = blackout.split("..", 1)
+        except ValueError:
+            raise DlmEngineConstraintError(
+                f"invalid blackout {blackout}, expected START..END"
+            )
+        self._start = self._parse(start, end=False)
+        self._end = self._parse(end, end=True)
+        if self._end <= self._start:
+            raise DlmEngineConstraintError(f"blackout {blackout} ends before it starts")
+
+    @staticmethod
+    def _parse(value, end):
+        value = value.strip()
+        try:
+            if "T" in value or " " in value:
+                return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+            date = datetime.datetime.combine(
+                datetime.date.fromisoformat(value), datetime.time()
+            )
+        except ValueError:
+            raise DlmEngineConstraintError(f"invalid blackout date {value}")
+        # a plain end date includes the whole day
+        return date + DAY if end else date
+
+    @property
+    def blackout(self):
+        return self._blackout
+
+    @property
+    def start(self):
+        return self._start
+
+    @property
+    def end(self):
+        return self._end
+
+    def matches(self, moment):
+        return self.start <= moment < self.end
+
+
+class DlmEngineCalendar:
+    def __init__(self, rules=None, blackouts=None, timezone=None):
+        self._rules = rules or list()
+        self._blackouts = sorted(blackouts or list(), key=lambda x: x.start)
+        self._timezone = None
+        if timezone:
+            try:
+                import zoneinfo
+
+                self._timezone = zoneinfo.ZoneInfo(timezone)
+            except (ImportError, ValueError, KeyError) as err:
+                raise DlmEngineConstraintError(f"invalid timezone {timezone}: {err}")
+
+    @classmethod
+    def from_args(cls, date_constraint=None, calendar=None, blackout=None, timezone=None):
+        rules = list()
+        if date_constraint:
+            for constraint in date_constraint.split(","):
+                rules.append(DlmEngineCronRule.from_legacy(constraint))
+        for expression in calendar or list():
+            rules.append(DlmEngineCronRule(expression))
+        blackouts = [DlmEngineBlackout(_blackout) for _blackout in blackout or list()]
+        return cls(rules=rules, blackouts=blackouts, timezone=timezone)
+
+    @property
+    def rules(self):
+        return self._rules
+
+    @property
+    def blackouts(self):
+        return self._blackouts
+
+    @property
+    def timezone(self):
+        return self._timezone
+
+    def __bool__(self):
+        return bool(self.rules or self.blackouts)
+
+    def now(self):
+        return datetime.datetime.now(self.timezone).replace(tzinfo=None)
+
+    def _local(self, moment):
+        if moment is None:
+            return self.now()
+        if moment.tzinfo is not None:
+            return moment.astimezone(self.timezone).replace(tzinfo=None)
+        return moment
+
+    def _aware(self, moment):
+        if moment is None:
+            return None
+        if self.timezone is not None:
+            return moment.replace(tzinfo=self.timezone)
+        return moment.astimezone()
+
+    def _blackout(self, moment):
+        for blackout in self.blackouts:
+            if blackout.matches(moment):
+                return blackout
+        return None
+
+    def _blackout_previous(self, moment):
+        ends = [blackout.end for blackout in self.blackouts if blackout.end <= moment]
+        return max(ends) if ends else None
+
+    def _blackout_next(self, moment):
+        for blackout in self.blackouts:
+            if blackout.start > moment:
+                return blackout
+        return None
+
+    def _matching_rules(self, moment):
+        if not self.rules:
+            return [None]
+        return [rule for rule in self.rules if rule.matches(moment)]
+
+    def matching_rule(self, moment=None):
+        moment = self._local(moment)
+        if self._blackout(moment):
+            return None
+        rules = self._matching_rules(moment)
+        if not rules:
+            return None
+        return rules[0]
+
+    def allowed(self, moment=None):
+        moment = self._local(moment)
+        if self._blackout(moment):
+            return False
+        return bool(self._matching_rules(moment))
+
+    def _next_start(self, moment):
+        for _ in range(len(self.blackouts) + 1):
+            if self.rules:
+                starts = [rule.next_match(moment) for rule in self.rules]
+                starts = [start for start in starts if start is not None]
+                if not starts:
+                    return None
+                moment = min(starts)
+            blackout = self._blackout(moment)
+            if not blackout:
+                return moment
+            moment = blackout.end
+        return None
+
+    def _window_end(self, start):
+        limit = start.replace(second=0, microsecond=0) + DAY * 366
+        blackout = self._blackout_next(start)
+        if blackout:
+            limit = min(limit, blackout.start)
+        if not self.rules:
+            return limit if blackout else None
+        end = start
+        while end < limit:
+            rules = [rule for rule in self.rules if rule.matches(end)]
+            if not rules:
+                break
+            end = max(rule.next_miss(end, limit) for rule in rules)
+        return end
+
+    def next_window(self, moment=None):
+        """
+        (start, end) of the window that contains moment or follows it,
+        end is exclusive and None for an open end. returns None if no
+        window can be found.
+        """
+        moment = self._local(moment)
+        start = self._next_start(moment)
+        if start is None:
+            return None
+        if start < moment:
+            start = moment
+        return self._aware(start), self._aware(self._window_end(start))
+
+    def window_start(self, moment=None):
+        """
+        start of the window that contains moment, None if moment is outside
+        of a window or there are no rules to define one.
+        """
+        moment = self._local(moment)
+        if not self.rules or not self.allowed(moment):
+            return None
+        start = moment.replace(second=0, microsecond=0)
+        limit = start - DAY * 366
+        blackout_end = self._blackout_previous(start)
+        if blackout_end:
+            limit = max(limit, blackout_end)
+        while start > limit:
+            rules = [rule for rule in self.rules if rule.matches(start - MINUTE)]
+            if not rules:
+                break
+            start = min(rule.first_match(start - MINUTE, limit) for rule in rules)
+        return self._aware(start)
+
+    def deadline(self, value, moment=None, window=False):
+        """
+        absolute deadline from an ISO date and time, or the next occurrence
+        of a time of day HH:MM. with window the open end of the current
+        window counts as deadline too, the earlier one wins. returns None
+        without deadline.
+        """
+        moment = self._local(moment)
+        deadlines = list()
+        if value:
+            try:
+                if len(value) <= 5:
+                    hour, minute = (int(part) for part in value.split(":"))
+                    deadline = moment.replace(
+                        hour=hour, minute=minute, second=0, microsecond=0
+                    )
+                    if deadline <= moment:
+                        deadline += DAY
+                else:
+                    deadline = datetime.datetime.fromisoformat(value)
+                    deadline = self._local(deadline) if deadline.tzinfo else deadline
+            except ValueError as err:
+                raise DlmEngineConstraintError(f"invalid deadline {value}: {err}")
+            deadlines.append(deadline)
+        if window and self and self.allowed(moment):
+            current = self.next_window(moment)
+            if current and current[1]:
+                deadlines.append(self._local(current[1]))
+        if not deadlines:
+            return None
+        return self._aware(min(deadlines))
+
+    def seconds_until_window(self, moment=None):
+        window = self.next_window(moment)
+        if window is None:
+            return None
+        return max(0.0, window[0].timestamp() - time.time())
@@ -0,0 +1,188 @@
+import datetime
+import gc
+import logging
+import signal
+import threading
+import time
+import traceback
+
+from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.updater import DlmEngineUpdater
+
+
+class DlmEngineUpdaterDaemon:
+    def __init__(
+        self,
+        cfg,
+        date_constraint,
+        random_sleep,
+        rerun=False,
+        calendar=None,
+        blackout=None,
+        timezone=None,
+        profile=None,
+        deadline=None,
+    ):
+        self._cfg = cfg
+        self._profile = profile
+        self._deadline = deadline
+        self._date_constraint = date_constraint
+        self._calendar = calendar
+        self._blackout = blackout
+        self._timezone = timezone
+        self._random_sleep = random_sleep
+        self._rerun = rerun
+        self._guard = None
+        self._updater = self._updater_create()
+        self._guard = self._updater.lock
+        self._guard.callback = self._request
+        self._reload = False
+        self._stop = False
+        self._trigger = False
+        self._cycling = False
+        self._wakeup = threading.Event()
+
+    @property
+    def updater(self) -> DlmEngineUpdater:
+        return self._updater
+
+    @property
+    def log(self) -> DlmLogger:
+        return self.updater.log
+
+    @property
+    def interval(self):
+        return self.updater.config.main.daemon.interval
+
+    def _updater_create(self):
+        updater = DlmEngineUpdater(
+            cfg=self._cfg,
+            after_reboot=False,
+            date_constraint=self._date_constraint,
+            random_sleep=self._random_sleep,
+            rerun=self._rerun,
+            calendar=self._calendar,
+            blackout=self._blackout,
+            timezone=self._timezone,
+            profile=self._profile,
+            deadline=self._deadline,
+        )
+        if self._guard:
+            # the guard of the first configuration stays, it cuts sleeps short after reboot
+            updater.lock = self._guard
+        return updater
+
+    def _request(self, request):
+        """a duplicate invocation is coalesced into the running cycle, or starts one now"""
+        if not self._cycling:
+            self._trigger = True
+            self._wakeup.set()
+
+    def _signal_reload(self, signum, frame):
+        self._reload = True
+        self._wakeup.set()
+
+    def _signal_stop(self, signum, frame):
+        self._stop = True
+        self._wakeup.set()
+
+    def reload(self):
+        self._reload = False
+        self.log.info("reloading configuration")
+        basedir = self.updater.config.main.basedir
+        application = logging.getLogger("application")
+        handlers, level = list(application.handlers), application.level
+        try:
+            updater = self._updater_create()
+        except (Exception, SystemExit) as err:
+            # the logger of a partially created updater writes every record a second time
+            for handler in list(application.handlers):
+                if handler not in handlers:
+                    application.removeHandler(handler)
+                    handler.close()
+            application.setLevel(level)
+            self.log.error(f"invalid configuration, keeping previous configuration: {err}")
+            return
+        self.updater.close()
+        self._updater = updater
+        if updater.config.main.basedir != basedir:
+            self.log.warning(
+                f"basedir changed to {updater.config.main.basedir}, "
+                f"local lock stays at {basedir} until restart"
+            )
+        self.log.info("configuration reloaded")
+
+    def cycle(self):
+        updater = self.updater
+        self._cycling = True
+        code = None
+        try:
+            task = updater.task
+            if task == "post_update":
+                updater.log.info("resuming post_update after reboot")
+            else:
+                updater.check_date_constraints()
+                if updater.rerun:
+                    updater.checkpoints_reset()
+                updater.random_sleep()
+            updater.run()
+        except SystemExit as err:
+            code = err.code
+            updater.log.info(f"update cycle finished with exit code {err.code}")
+        except Exception as err:
+            # for example a lock api that can not be reached, the next cycle tries again
+            code = 1
+            updater.log.error(
+                f"update cycle failed: {err!r}\n{traceback.format_exc().rstrip()}"
+            )
+        finally:
+            self._cycling = False
+            self._guard.notify(code)
+            self._rerun = False
+            updater.rerun = False
+            updater.reset()
+            gc.collect()
+
+    def next_cycle(self, earliest):
+        constraints = self.updater.date_constraints
+        if not constraints or self.updater.task == "post_update":
+            return earliest
+        window = constraints.next_window(
+            datetime.datetime.fromtimestamp(earliest, datetime.timezone.utc)
+        )
+        if window is None:
+            self.log.warning("date constraints have no future window")
+            return earliest
+        return max(earliest, window[0].timestamp())
+
+    def work(self):
+        signal.signal(signal.SIGHUP, self._signal_reload)
+        signal.signal(signal.SIGTERM, self._signal_stop)
+        signal.signal(signal.SIGINT, self._signal_stop)
+        self.log.info(
+            f"running dlm engine updater daemon as {self.updater.user_root.pw_name}"
+        )
+        self._guard.acquire()
+        next_cycle = self.next_cycle(time.time())
+        while not self._stop:
+            if self._reload:
+                self.reload()
+                next_cycle = self.next_cycle(next_cycle)
+            if self._trigger:
+                self._trigger = False
+                self.log.info("update cycle requested by a duplicate invocation")
+                next_cycle = time.time()
+            timeout = next_cycle - time.time()
+            if timeout > 0:
+                # wake up regularly, the wall clock may jump
+                self._wakeup.wait(min(timeout, 300))
+                self._wakeup.clear()
+                continue
+            self.cycle()
+            next_cycle = self.next_cycle(time.time() + self.interval)
+            self.log.info(
+                f"next update cycle at {datetime.datetime.fromtimestamp(next_cycle).isoformat()}"
+            )
+        self.log.info("stopping dlm engine updater daemon")
+        self.updater.close()
+        self._guard.release()
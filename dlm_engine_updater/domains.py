@@ -0,0 +1,189 @@
+import os
+import sys
+import threading
+
+from dlm_engine_updater.config import DlmUpdaterConfig
+from dlm_engine_updater.guard import DlmEngineGuard
+from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.plugin import DlmEnginePluginManager
+from dlm_engine_updater.plugin import DlmEngineStep
+from dlm_engine_updater.updater import DlmEngineUpdater
+
+
+class DlmEngineDomains:
+    """
+    runs every update domain of the configuration in one process. each
+    domain has its own lock name, basedir, scripts and state. domains that
+    do not conflict run concurrently, reboots are left to the coordinator
+    so a single reboot serves all domains that need one.
+    """
+
+    def __init__(
+        self,
+        cfg,
+        after_reboot,
+        date_constraint,
+        random_sleep,
+        rerun=False,
+        calendar=None,
+        blackout=None,
+        timezone=None,
+        profile=None,
+        deadline=None,
+    ):
+        self._config = DlmUpdaterConfig(_env_file=cfg)
+        self._plugin_manager = DlmEnginePluginManager(self._config)
+        self._log = DlmLogger(self._config, plugin_manager=self._plugin_manager)
+        self._plugin_manager.log = self._log
+        self._plugin_manager.init()
+        self._after_reboot = after_reboot
+        self._lock = DlmEngineGuard(self.config.main.basedir, log=self.log)
+        self._updaters = dict()
+        for name, domain in self.config.domain.items():
+            if not domain.enabled:
+                continue
+            updater = DlmEngineUpdater(
+                cfg=cfg,
+                after_reboot=after_reboot,
+                date_constraint=date_constraint,
+                random_sleep=random_sleep,
+                rerun=rerun,
+                calendar=calendar,
+                blackout=blackout,
+                timezone=timezone,
+                profile=profile,
+                deadline=deadline,
+                domain=name,
+                config=self.config,
+                plugin_manager=self._plugin_manager,
+            )
+            updater.reboot_defer = True
+            # a resume after reboot cuts the sleep of the coordinator short
+            updater.lock = self._lock
+            self._updaters[name] = updater
+        if not self._updaters:
+            self.log.fatal("all update domains are disabled")
+            sys.exit(1)
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def lock(self) -> DlmEngineGuard:
+        return self._lock
+
+    @property
+    def updaters(self) -> dict:
+        return self._updaters
+
+    def conflict(self, name, other):
+        domains = self.config.domain
+        if domains[name].lockname == domains[other].lockname:
+            return True
+        if other in (domains[name].conflicts or []):
+            return True
+        return name in (domains[other].conflicts or [])
+
+    def waves(self, names):
+        """groups of domains without conflicts among each other, in configuration order"""
+        waves = list()
+        for name in names:
+            for wave in waves:
+                if not any(self.conflict(name, other) for other in wave):
+                    wave.append(name)
+                    break
+            else:
+                waves.append([name])
+        return waves
+
+    def random_sleep(self):
+        # one sleep for all domains, the updaters only sleep when they run on their own
+        next(iter(self.updaters.values())).random_sleep()
+
+    def _run_domain(self, name, results):
+        try:
+            self.updaters[name].run()
+        except SystemExit as err:
+            results[name] = err.code
+        except Exception as err:
+            self.log.error(f"domain {name} failed: {err!r}")
+            results[name] = 1
+        finally:
+            if self.updaters[name].status:
+                self.updaters[name].status.stop()
+
+    def run_wave(self, wave, results):
+        self.log.info(f"running update domains {', '.join(wave)}")
+        threads = [
+            threading.Thread(
+                target=self._run_domain, args=(name, results), name=f"domain-{name}"
+            )
+            for name in wave
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def reboot_scripts(self, pending):
+        """reboot.d scripts of all pending domains, a name shared by domains runs once"""
+        scripts = dict()
+        for name in pending:
+            updater = self.updaters[name]
+            for _file, _user in updater.get_scripts("reboot.d", phase="reboot"):
+                key = _file.name if isinstance(_file, DlmEngineStep) else os.path.basename(_file)
+                if key not in scripts:
+                    scripts[key] = (updater, _file, _user)
+        return [scripts[key] for key in sorted(scripts)]
+
+    def reboot_run(self, pending):
+        for updater, _file, _user in self.reboot_scripts(pending):
+            updater.log.info(f"running: {_file}", phase="reboot")
+            return_code = updater.run_script(_file, _user, phase="reboot")
+            if return_code != 0:
+                updater.log.info("script failed, stopping, keeping lock", phase="reboot")
+                updater.on_failure(phase="reboot", script=_file, return_code=return_code)
+                sys.exit(1)
+            updater.do_ext_notify(phase="reboot", script=_file, return_code=return_code)
+            updater.log.info(f"running: {_file} done", phase="reboot")
+
+    def work(self):
+        self.log.info(
+            f"running dlm engine updater for domains {', '.join(self.updaters)}"
+        )
+        next(iter(self.updaters.values())).check_date_constraints()
+        self.lock.acquire(after_reboot=self._after_reboot, wait=self.config.main.guard.wait)
+        names = list(self.updaters)
+        if self._after_reboot:
+            names = [name for name in names if self.updaters[name].task == "post_update"]
+            if not names:
+                self.log.info("reboot was not triggered by dlm_engine_updater, exiting")
+                sys.exit(0)
+            self.log.info(f"picking up remaining tasks of domains {', '.join(names)}")
+        for name in names:
+            if self.updaters[name].rerun:
+                self.updaters[name].checkpoints_reset()
+        self.random_sleep()
+        results = dict()
+        for wave in self.waves(names):
+            self.run_wave(wave, results)
+        failed = [name for name, code in results.items() if code not in (0, None)]
+        if failed:
+            self.log.error(f"update domains failed: {', '.join(failed)}")
+        pending = [name for name in names if self.updaters[name].reboot_pending]
+        if pending:
+            self.log.info(f"rebooting once for domains {', '.join(pending)}", phase="reboot")
+            self.log.index_flush()
+            try:
+                self.reboot_run(pending)
+            finally:
+                for name in pending:
+                    self.updaters[name].metrics.write()
+        code = 1 if failed else 0
+        self.lock.release(code)
+        sys.exit(code)
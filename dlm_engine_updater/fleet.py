@@ -0,0 +1,492 @@
+"""
+fleet report over run histories and trace files collected from many hosts.
+
+used by the report command line, it must only import the standard library
+and modules of this package that do the same. input files are streamed one
+run at a time and aggregated into mergeable summaries, memory grows with
+the number of hosts, lock names and distinct scripts, not with the runs.
+"""
+
+import datetime
+import gzip
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+
+from dlm_engine_updater.trace import STATUS_ERROR
+
+# relative error of the duration percentiles
+HISTOGRAM_GROWTH = 1.02
+HISTOGRAM_MIN = 0.001
+# a non zero return code is the expected answer of these phases
+ANSWER_PHASES = ["needs_update", "needs_reboot"]
+
+
+class DlmEngineHistogram:
+    """log bucketed histogram, percentiles are exact to HISTOGRAM_GROWTH"""
+
+    def __init__(self):
+        self._buckets = dict()
+        self._count = 0
+        self._max = None
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def max(self):
+        return self._max
+
+    def add(self, value):
+        if value is None:
+            return
+        if value <= HISTOGRAM_MIN:
+            bucket = None
+        else:
+            bucket = math.ceil(math.log(value / HISTOGRAM_MIN, HISTOGRAM_GROWTH))
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self._count += 1
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def merge(self, other):
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        self._count += other._count
+        if other._max is not None and (self._max is None or other._max > self._max):
+            self._max = other._max
+
+    def percentile(self, pct):
+        if not self._count:
+            return None
+        rank = max(1, math.ceil(pct / 100.0 * self._count))
+        seen = 0
+        for bucket in sorted(self._buckets, key=lambda b: -1 if b is None else b):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                if bucket is None:
+                    return 0.0
+                return min(HISTOGRAM_MIN * HISTOGRAM_GROWTH**bucket, self._max)
+        return self._max
+
+
+def _attributes(attributes):
+    values = dict()
+    for attribute in attributes or []:
+        value = attribute.get("value", {})
+        for kind in ["stringValue", "intValue", "doubleValue", "boolValue"]:
+            if kind in value:
+                values[attribute["key"]] = int(value[kind]) if kind == "intValue" else value[kind]
+                break
+    return values
+
+
+def _run(host, lock_name, started):
+    return {
+        "host": host,
+        "lock_name": lock_name,
+        "started": started,
+        "finished": None,
+        "outcome": None,
+        "lock_wait": None,
+        "lock_acquired": None,
+        "lock_released": None,
+        "reboot_duration": None,
+        "phases": list(),
+        "scripts": list(),
+    }
+
+
+def history_runs(path, since=None, until=None):
+    """runs of a history.db, oldest first"""
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        query = (
+            "SELECT run_id, host, lock_name, started, finished, outcome, lock_wait, "
+            "lock_acquired, lock_released, reboot_duration FROM runs WHERE started >= ? AND started < ? "
+            "ORDER BY started"
+        )
+        window = (since if since is not None else 0, until if until is not None else math.inf)
+        for row in db.execute(query, window).fetchall():
+            run = _run(row[1], row[2], row[3])
+            for key, value in zip(
+                ["finished", "outcome", "lock_wait", "lock_acquired", "lock_released", "reboot_duration"],
+                row[4:],
+            ):
+                run[key] = value
+            run["phases"] = db.execute(
+                "SELECT phase, duration, outcome FROM phases WHERE run_id = ?", (row[0],)
+            ).fetchall()
+            run["scripts"] = db.execute(
+                "SELECT phase, script, duration, return_code FROM scripts WHERE run_id = ?",
+                (row[0],),
+            ).fetchall()
+            yield run
+    finally:
+        db.close()
+
+
+def _trace_finish(run):
+    """derive what the history records directly from the spans of a run"""
+    lock_get = run.pop("_lock_get", None)
+    if lock_get:
+        run["lock_wait"] = lock_get[1] - lock_get[0]
+        run["lock_acquired"] = lock_get[1]
+    run["lock_released"] = run.pop("_lock_release", None)
+    phases = [phase for phase, _, _ in run["phases"]]
+    if run["outcome"] is None:
+        if any(outcome == "failed" for _, _, outcome in run["phases"]):
+            run["outcome"] = "failed"
+        elif "post_release" in phases:
+            run["outcome"] = "success"
+        elif phases == ["needs_update"]:
+            run["outcome"] = "no_updates"
+        else:
+            run["outcome"] = "interrupted"
+    return run
+
+
+def trace_runs(path, since=None, until=None):
+    """
+    runs of an OTLP JSON lines trace file, as written by main_trace_file. the
+    spans of a run can be spread over several lines if it rebooted, a run is
+    complete with its root span.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    pending = dict()
+    with opener(path, "rt") as trace:
+        for line in trace:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for resource_spans in record.get("resourceSpans", []):
+                host = _attributes(resource_spans.get("resource", {}).get("attributes")).get("host.name")
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    for span in scope_spans.get("spans", []):
+                        start = int(span["startTimeUnixNano"]) / 1e9
+                        end = int(span["endTimeUnixNano"]) / 1e9
+                        attributes = _attributes(span.get("attributes"))
+                        name = span.get("name", "")
+                        run = pending.setdefault(span["traceId"], _run(host, None, start))
+                        run["started"] = min(run["started"], start)
+                        failed = span.get("status", {}).get("code") == STATUS_ERROR
+                        if name == "dlm_engine_updater run":
+                            run["lock_name"] = attributes.get("dlm.lock_name")
+                            run["finished"] = end
+                            run = _trace_finish(pending.pop(span["traceId"]))
+                            if (since is None or run["started"] >= since) and (
+                                until is None or run["started"] < until
+                            ):
+                                yield run
+                        elif name.startswith("phase "):
+                            phase = attributes.get("dlm.phase")
+                            run["phases"].append((phase, end - start, "failed" if failed else "ok"))
+                            if phase == "lock_get" and not failed:
+                                run["_lock_get"] = (start, end)
+                            elif phase == "lock_release" and not failed:
+                                run["_lock_release"] = end
+                        elif name.startswith("script ") or name.startswith("step "):
+                            run["scripts"].append(
+                                (
+                                    attributes.get("dlm.phase"),
+                                    attributes.get("dlm.script"),
+                                    end - start,
+                                    attributes.get("dlm.return_code"),
+                                )
+                            )
+    # runs without root span did not finish within this file
+    for run in pending.values():
+        run["outcome"] = "interrupted"
+        run = _trace_finish(run)
+        if (since is None or run["started"] >= since) and (until is None or run["started"] < until):
+            yield run
+
+
+def runs(path, since=None, until=None):
+    if path.endswith(".db"):
+        return history_runs(path, since=since, until=until)
+    return trace_runs(path, since=since, until=until)
+
+
+def discover(paths):
+    """
+    history databases and trace files below paths. a host records every run
+    in both if it has tracing enabled, trace files in or below a directory
+    with a history database are skipped.
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        histories = list()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if any(name.endswith(".db") for name in files):
+                histories.append(root)
+            for name in sorted(files):
+                if name.endswith(".db"):
+                    yield os.path.join(root, name)
+                elif ".jsonl" in name and not any(
+                    root == history or root.startswith(history + os.sep) for history in histories
+                ):
+                    yield os.path.join(root, name)
+
+
+class DlmEngineFleet:
+    """mergeable summary of the runs of many hosts"""
+
+    def __init__(self, bin_size=300, samples=3):
+        self._bin = bin_size
+        self._samples = samples
+        self.hosts = set()
+        self.files = 0
+        self.errors = list()
+        self.runs = 0
+        self.outcomes = dict()
+        self.first_start = None
+        self.last_finish = None
+        self.durations = DlmEngineHistogram()
+        self.lock_wait = DlmEngineHistogram()
+        self.lock_hold = DlmEngineHistogram()
+        self.reboot = DlmEngineHistogram()
+        self.phases = dict()
+        self.scripts = dict()
+        self.script_failures = dict()
+        self.locks = dict()
+        # time bin: [started, finished, failed, waiting delta, holding delta]
+        self.timeline = dict()
+        # (phase, script, return code): [runs, sample hosts]
+        self.failures = dict()
+
+    def _bin_of(self, moment):
+        return int(moment // self._bin)
+
+    def _timeline(self, moment, index, value=1):
+        counts = self.timeline.setdefault(self._bin_of(moment), [0, 0, 0, 0, 0])
+        counts[index] += value
+
+    def _interval(self, start, end, index):
+        """count the interval in every bin it touches"""
+        if start is None or end is None or end < start:
+            return
+        self._timeline(start, index)
+        self.timeline.setdefault(self._bin_of(end) + 1, [0, 0, 0, 0, 0])[index] -= 1
+
+    def _failure(self, key, host):
+        cluster = self.failures.setdefault(key, [0, list()])
+        cluster[0] += 1
+        if host not in cluster[1] and len(cluster[1]) < self._samples:
+            cluster[1].append(host)
+
+    def add(self, run):
+        self.runs += 1
+        host = run["host"] or "unknown"
+        self.hosts.add(host)
+        outcome = run["outcome"] or "unknown"
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        started, finished = run["started"], run["finished"]
+        if started is not None:
+            self.first_start = started if self.first_start is None else min(self.first_start, started)
+            self._timeline(started, 0)
+        if finished is not None:
+            self.last_finish = finished if self.last_finish is None else max(self.last_finish, finished)
+            self._timeline(finished, 2 if outcome == "failed" else 1)
+            if started is not None:
+                self.durations.add(finished - started)
+        acquired, released, wait = run["lock_acquired"], run["lock_released"], run["lock_wait"]
+        self.lock_wait.add(wait)
+        self.reboot.add(run["reboot_duration"])
+        if acquired is not None and wait is not None:
+            self._interval(acquired - wait, acquired, 3)
+        if acquired is not None and released is not None:
+            self.lock_hold.add(released - acquired)
+            self._interval(acquired, released, 4)
+        if wait is not None:
+            lock = self.locks.setdefault(run["lock_name"] or "unknown", DlmEngineHistogram())
+            lock.add(wait)
+
+        failing_scripts = set()
+        for phase, script, duration, return_code in run["scripts"]:
+            key = (phase, script)
+            self.scripts.setdefault(key, DlmEngineHistogram()).add(duration)
+            if return_code and phase not in ANSWER_PHASES:
+                self.script_failures[key] = self.script_failures.get(key, 0) + 1
+                self._failure((phase, script, return_code), host)
+                failing_scripts.add(phase)
+        for phase, duration, phase_outcome in run["phases"]:
+            self.phases.setdefault(phase, DlmEngineHistogram()).add(duration)
+            # a phase can fail without a script, lock_get for example
+            if phase_outcome == "failed" and phase not in failing_scripts:
+                self._failure((phase, None, None), host)
+
+    def merge(self, other):
+        self.hosts |= other.hosts
+        self.files += other.files
+        self.errors.extend(other.errors)
+        self.runs += other.runs
+        for outcome, count in other.outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+        if other.first_start is not None:
+            self.first_start = min(filter(None, [self.first_start, other.first_start]))
+        if other.last_finish is not None:
+            self.last_finish = max(filter(None, [self.last_finish, other.last_finish]))
+        for histogram in ["durations", "lock_wait", "lock_hold", "reboot"]:
+            getattr(self, histogram).merge(getattr(other, histogram))
+        for mapping in ["phases", "scripts", "locks"]:
+            mine = getattr(self, mapping)
+            for key, histogram in getattr(other, mapping).items():
+                mine.setdefault(key, DlmEngineHistogram()).merge(histogram)
+        for key, count in other.script_failures.items():
+            self.script_failures[key] = self.script_failures.get(key, 0) + count
+        for key, counts in other.timeline.items():
+            mine = self.timeline.setdefault(key, [0, 0, 0, 0, 0])
+            for index, count in enumerate(counts):
+                mine[index] += count
+        for key, (count, hosts) in other.failures.items():
+            cluster = self.failures.setdefault(key, [0, list()])
+            cluster[0] += count
+            for host in hosts:
+                if host not in cluster[1] and len(cluster[1]) < self._samples:
+                    cluster[1].append(host)
+
+    def read(self, path, since=None, until=None):
+        self.files += 1
+        try:
+            for run in runs(path, since=since, until=until):
+                self.add(run)
+        except (OSError, sqlite3.Error, KeyError, ValueError) as err:
+            self.errors.append(f"{path}: {err}")
+
+    def print(self, top=10):
+        def stats(histogram):
+            if not histogram.count:
+                return f"{0:6d} {'-':>9} {'-':>9} {'-':>9} {'-':>9}"
+            return (
+                f"{histogram.count:6d} {histogram.percentile(50):9.2f} {histogram.percentile(90):9.2f} "
+                f"{histogram.percentile(99):9.2f} {histogram.max:9.2f}"
+            )
+
+        def moment(value):
+            return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            )
+
+        for error in self.errors:
+            print(f"skipped {error}")
+        if not self.runs:
+            print(f"no runs found in {self.files} files")
+            return
+        print(
+            f"{self.runs} runs of {len(self.hosts)} hosts from {self.files} files: "
+            + ", ".join(f"{outcome} {count}" for outcome, count in sorted(self.outcomes.items()))
+        )
+        if self.first_start is not None and self.last_finish is not None:
+            print(
+                f"makespan {self.last_finish - self.first_start:.0f}s, "
+                f"{moment(self.first_start)} - {moment(self.last_finish)}"
+            )
+        header = f"{'count':>6} {'p50 s':>9} {'p90 s':>9} {'p99 s':>9} {'max s':>9}"
+
+        print()
+        print(f"{'':24} {header}")
+        print(f"{'run duration':24} {stats(self.durations)}")
+        print(f"{'lock wait':24} {stats(self.lock_wait)}")
+        print(f"{'lock hold':24} {stats(self.lock_hold)}")
+        print(f"{'reboot':24} {stats(self.reboot)}")
+        for phase, histogram in sorted(self.phases.items()):
+            print(f"{'phase ' + phase:24} {stats(histogram)}")
+
+        print()
+        print(f"{header} most contended locks")
+        contended = sorted(self.locks.items(), key=lambda x: x[1].percentile(90), reverse=True)
+        for lock_name, histogram in contended[:top]:
+            print(f"{stats(histogram)} {lock_name}")
+
+        print()
+        print(f"{'time':20} {'started':>8} {'waiting':>8} {'holding':>8} {'finished':>8} {'failed':>8} done")
+        waiting = holding = done = 0
+        total = max(1, self.runs)
+        for key in sorted(self.timeline):
+            counts = self.timeline[key]
+            waiting += counts[3]
+            holding += counts[4]
+            done += counts[1] + counts[2]
+            if not (counts[0] or counts[1] or counts[2] or waiting or holding):
+                continue
+            print(
+                f"{moment(key * self._bin):20} {counts[0]:8d} {waiting:8d} {holding:8d} "
+                f"{counts[1]:8d} {counts[2]:8d} {100.0 * done / total:3.0f}%"
+            )
+
+        print()
+        print(f"{header} {'failed':>6} slowest scripts")
+        slowest = sorted(self.scripts.items(), key=lambda x: x[1].percentile(90), reverse=True)
+        for key, histogram in slowest[:top]:
+            print(f"{stats(histogram)} {self.script_failures.get(key, 0):6d} {key[0]} {key[1]}")
+
+        print()
+        print(f"{'runs':>6} {'rc':>4} failure clusters")
+        clusters = sorted(self.failures.items(), key=lambda x: x[1][0], reverse=True)
+        if not clusters:
+            print("none")
+        for (phase, script, return_code), (count, hosts) in clusters[:top]:
+            rc = "-" if return_code is None else str(return_code)
+            print(f"{count:6d} {rc:>4} {phase} {script or '-'}, hosts {', '.join(hosts)}")
+
+
+def _aggregate(args):
+    paths, since, until, bin_size, samples = args
+    fleet = DlmEngineFleet(bin_size=bin_size, samples=samples)
+    for path in paths:
+        fleet.read(path, since=since, until=until)
+    return fleet
+
+
+def _chunks(paths, size):
+    chunk = list()
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def parse_moment(value):
+    """epoch seconds or an ISO date and time, UTC unless given"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def report(paths, since=None, until=None, bin_size=300, top=10, jobs=None, samples=3, chunk=16):
+    """aggregate the files below paths in worker processes, used by the report command"""
+    try:
+        since, until = parse_moment(since), parse_moment(until)
+    except ValueError as err:
+        print(f"invalid time: {err}")
+        return 1
+    fleet = DlmEngineFleet(bin_size=bin_size, samples=samples)
+    work = ((paths, since, until, bin_size, samples) for paths in _chunks(discover(paths), chunk))
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        for args in work:
+            fleet.merge(_aggregate(args))
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            for partial in pool.imap_unordered(_aggregate, work):
+                fleet.merge(partial)
+    fleet.print(top=top)
+    return 0
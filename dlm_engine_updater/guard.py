@@ -0,0 +1,225 @@
+"""
+local guard against concurrent invocations on the same basedir.
+
+the running instance holds an flock on {basedir}/lock, like a pid file, and
+answers on {basedir}/guard.sock. a second invocation does not fail or pile
+up, it hands its request to the running instance and exits. the client side
+is used by the fast exit checks, it must only import the standard library
+and modules of this package that do the same.
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import socket
+import threading
+
+from dlm_engine_updater.startup import peek_task
+
+GUARD_SOCKET = "guard.sock"
+# the running instance did not finish within the wait time, like EX_TEMPFAIL
+EXIT_TIMEOUT = 75
+
+
+def coalesce(basedir, after_reboot=False, wait=0):
+    """
+    hand the request to the instance running on basedir. returns exit code
+    and message for the caller, the code is the one of the running instance
+    if the caller waits for it, None if no instance answered.
+    """
+    path = os.path.join(basedir, GUARD_SOCKET)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(5)
+    try:
+        client.connect(path)
+        stream = client.makefile("rwb")
+        stream.write(
+            json.dumps({"pid": os.getpid(), "after_reboot": after_reboot, "wait": wait}).encode()
+            + b"\n"
+        )
+        stream.flush()
+        answer = json.loads(stream.readline())
+        running = f"dlm_engine_updater pid {answer['pid']} in phase {answer['task']}"
+        if not wait:
+            return 0, f"coalesced into running {running}"
+        client.settimeout(wait)
+        try:
+            line = stream.readline()
+        except socket.timeout:
+            return EXIT_TIMEOUT, f"{running} did not finish within {wait} seconds"
+        if not line:
+            return 1, f"{running} went away without result"
+        code = json.loads(line).get("code")
+        return code or 0, f"coalesced into {running}, finished with exit code {code or 0}"
+    except (OSError, ValueError, KeyError):
+        return None, f"Already running according to {basedir}/lock"
+    finally:
+        client.close()
+
+
+class DlmEngineGuard:
+    """
+    flock on {basedir}/lock plus a unix socket for duplicate invocations.
+    requests are answered right away, callers that wait are answered again
+    with the exit code once the guard is released. a resume after reboot
+    cuts sleep() short.
+    """
+
+    def __init__(self, basedir, log=None, callback=None):
+        self._basedir = basedir
+        self._log = log
+        self._callback = callback
+        self._lockfile = None
+        self._socket = None
+        self._thread = None
+        self._waiters = list()
+        self._mutex = threading.Lock()
+        self._priority = threading.Event()
+
+    @property
+    def path(self):
+        return os.path.join(self._basedir, "lock")
+
+    @property
+    def socket_path(self):
+        return os.path.join(self._basedir, GUARD_SOCKET)
+
+    @property
+    def callback(self):
+        return self._callback
+
+    @callback.setter
+    def callback(self, value):
+        self._callback = value
+
+    @property
+    def acquired(self):
+        return self._lockfile is not None
+
+    def _info(self, msg):
+        if self._log:
+            self._log.info(msg)
+
+    def acquire(self, after_reboot=False, wait=0):
+        """take the guard, or hand the request to the running instance and exit"""
+        try:
+            lockfile = open(self.path, "a")
+        except OSError as err:
+            raise SystemExit(err)
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lockfile.close()
+            code, msg = coalesce(self._basedir, after_reboot=after_reboot, wait=wait)
+            if code is None:
+                raise SystemExit(msg)
+            self._info(msg)
+            raise SystemExit(code)
+        lockfile.seek(0)
+        lockfile.truncate()
+        lockfile.write(f"{os.getpid()}\n")
+        lockfile.flush()
+        self._lockfile = lockfile
+        atexit.register(self.release)
+        self._serve()
+
+    def _serve(self):
+        try:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            self._socket.listen(16)
+        except OSError as err:
+            if self._log:
+                self._log.warning(f"duplicate invocations can not be coalesced: {err}")
+            self._socket = None
+            return
+        self._thread = threading.Thread(target=self._accept, name="dlm-guard", daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            try:
+                self._request(connection)
+            except (OSError, ValueError) as err:
+                self._info(f"dropping invalid guard request: {err}")
+                connection.close()
+
+    def _request(self, connection):
+        connection.settimeout(5)
+        stream = connection.makefile("rwb")
+        request = json.loads(stream.readline())
+        after_reboot = bool(request.get("after_reboot"))
+        self._info(
+            f"coalescing invocation of pid {request.get('pid')}"
+            + (" after reboot" if after_reboot else "")
+        )
+        if after_reboot:
+            self._priority.set()
+        if self.callback:
+            self.callback(request)
+        stream.write(
+            json.dumps({"pid": os.getpid(), "task": peek_task(self._basedir)}).encode() + b"\n"
+        )
+        stream.flush()
+        if request.get("wait"):
+            with self._mutex:
+                self._waiters.append((connection, stream))
+        else:
+            connection.close()
+
+    @property
+    def priority(self):
+        """a resume after reboot was requested"""
+        return self._priority.is_set()
+
+    def sleep(self, seconds):
+        """sleep, returns True if a resume after reboot cut the sleep short"""
+        return self._priority.wait(seconds)
+
+    def notify(self, code=None):
+        """answer invocations waiting for the current run with its exit code"""
+        with self._mutex:
+            waiters, self._waiters = self._waiters, list()
+        for connection, stream in waiters:
+            try:
+                stream.write(json.dumps({"code": code}).encode() + b"\n")
+                stream.flush()
+            except OSError:
+                pass
+            connection.close()
+        self._priority.clear()
+
+    def release(self, code=None):
+        """answer waiting invocations with code, stop serving and drop the lock"""
+        if self._lockfile is None:
+            return
+        self.notify(code)
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+            self._thread.join()
+            self._socket = None
+            self._thread = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+        # never unlink the lock file, an instance that opened it before would hold the lock on
+        # the old inode next to one that creates a new file. drop the pid, the flock is what counts
+        try:
+            self._lockfile.truncate(0)
+        except OSError:
+            pass
+        self._lockfile.close()
+        self._lockfile = None
@@ -0,0 +1,374 @@
+"""
+local run history in a sqlite database below basedir.
+
+this module is also used by the history command line, it must only import
+the standard library and modules of this package that do the same.
+"""
+
+import os
+import socket
+import sqlite3
+import time
+
+from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.state import DlmEngineJournalError
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY,
+        host TEXT,
+        lock_name TEXT,
+        started REAL,
+        finished REAL,
+        outcome TEXT,
+        lock_wait REAL,
+        lock_attempts INTEGER,
+        lock_acquired REAL,
+        lock_released REAL,
+        reboot_duration REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS phases (
+        run_id TEXT,
+        phase TEXT,
+        started REAL,
+        duration REAL,
+        outcome TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scripts (
+        run_id TEXT,
+        phase TEXT,
+        script TEXT,
+        user TEXT,
+        started REAL,
+        duration REAL,
+        return_code INTEGER,
+        cpu_user REAL,
+        cpu_system REAL,
+        max_rss INTEGER,
+        block_in INTEGER,
+        block_out INTEGER,
+        ctx_voluntary INTEGER,
+        ctx_involuntary INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS phases_run_id ON phases (run_id)",
+    "CREATE INDEX IF NOT EXISTS scripts_run_id ON scripts (run_id)",
+    "CREATE INDEX IF NOT EXISTS runs_started ON runs (started)",
+]
+
+# columns added to tables of older databases on connect
+MIGRATIONS = {
+    "scripts": [
+        ("cpu_user", "REAL"),
+        ("cpu_system", "REAL"),
+        ("max_rss", "INTEGER"),
+        ("block_in", "INTEGER"),
+        ("block_out", "INTEGER"),
+        ("ctx_voluntary", "INTEGER"),
+        ("ctx_involuntary", "INTEGER"),
+    ],
+}
+
+USAGE_COLUMNS = [column for column, _ in MIGRATIONS["scripts"]]
+
+RUN_COLUMNS = [
+    "host",
+    "lock_name",
+    "started",
+    "finished",
+    "outcome",
+    "lock_wait",
+    "lock_attempts",
+    "lock_acquired",
+    "lock_released",
+    "reboot_duration",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def connect(path):
+    # update domains record from their own thread, the coordinator runs the reboot scripts
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    for statement in SCHEMA:
+        db.execute(statement)
+    for table, columns in MIGRATIONS.items():
+        present = [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+        for column, _type in columns:
+            if column not in present:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {_type}")
+    db.commit()
+    return db
+
+
+class DlmEngineHistory:
+    """
+    one row per update run plus its phases and scripts.
+
+    like the trace context, the run id lives in the state journal, so the
+    processes before and after a reboot record into the same run. the run
+    id also tags the log index, it is kept with the history disabled too.
+    """
+
+    def __init__(self, log, path, journal, lock_name, enabled=True, retention=90, max_runs=1000):
+        self._log = log
+        self._path = path
+        self._journal = journal
+        self._lock_name = lock_name
+        self._enabled = enabled
+        self._retention = retention
+        self._max_runs = max_runs
+        self._db = None
+        self._run = None
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect(self.path)
+        return self._db
+
+    @property
+    def run_id(self):
+        if self._run is None:
+            self._run = self.journal.get("history")
+            if not self._run:
+                self._run = {"run_id": os.urandom(8).hex(), "started": time.time()}
+                try:
+                    self.journal.set("history", self._run)
+                except DlmEngineJournalError as err:
+                    self.log.warning(f"could not persist history run id: {err}")
+            if self.enabled:
+                self._execute(
+                    "INSERT OR IGNORE INTO runs (run_id, host, lock_name, started) VALUES (?, ?, ?, ?)",
+                    (self._run["run_id"], socket.getfqdn(), self._lock_name, self._run["started"]),
+                )
+        return self._run["run_id"]
+
+    def _execute(self, statement, parameters):
+        try:
+            self.db.execute(statement, parameters)
+            self.db.commit()
+        except sqlite3.Error as err:
+            self.log.warning(f"could not write run history: {err}")
+
+    def update(self, **values):
+        """change the given columns of the current run"""
+        if not self.enabled:
+            return
+        unknown = set(values) - set(RUN_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown run history columns: {sorted(unknown)}")
+        columns = ", ".join(f"{column} = ?" for column in values)
+        self._execute(
+            f"UPDATE runs SET {columns} WHERE run_id = ?",
+            tuple(values.values()) + (self.run_id,),
+        )
+
+    def phase(self, phase, started, duration, outcome):
+        if not self.enabled:
+            return
+        self._execute(
+            "INSERT INTO phases (run_id, phase, started, duration, outcome) VALUES (?, ?, ?, ?, ?)",
+            (self.run_id, phase, started, duration, outcome),
+        )
+
+    def script(self, phase, script, user, started, duration, return_code, usage=None):
+        if not self.enabled:
+            return
+        usage = usage or dict()
+        columns = ", ".join(USAGE_COLUMNS)
+        marks = ", ".join("?" for _ in USAGE_COLUMNS)
+        self._execute(
+            f"INSERT INTO scripts (run_id, phase, script, user, started, duration, return_code, {columns}) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, {marks})",
+            (self.run_id, phase, script, user, started, duration, return_code)
+            + tuple(usage.get(column) for column in USAGE_COLUMNS),
+        )
+
+    def estimate(self, phases, pct=90, runs=20):
+        """
+        expected duration of phases, the percentile of the per run total of
+        their durations and of the reboot duration over the last successful
+        runs. returns None without successful runs.
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return None
+        try:
+            totals = {
+                row[0]: row[1] or 0.0
+                for row in self.db.execute(
+                    "SELECT run_id, reboot_duration FROM runs WHERE outcome = 'success' "
+                    "ORDER BY started DESC LIMIT ?",
+                    (runs,),
+                )
+            }
+            if not totals:
+                return None
+            marks = ", ".join("?" for _ in totals)
+            for run_id, phase, duration in self.db.execute(
+                f"SELECT run_id, phase, duration FROM phases WHERE run_id IN ({marks})",
+                list(totals),
+            ):
+                if phase in phases:
+                    totals[run_id] += duration
+        except sqlite3.Error as err:
+            self.log.warning(f"could not read run history: {err}")
+            return None
+        # phases are slow in different runs, the sum of their percentiles would overestimate
+        return percentile(list(totals.values()), pct)
+
+    def finish(self, outcome, done):
+        """
+        record the outcome of this process, if the run is done prune old
+        runs and drop the run id from the journal.
+        """
+        if self._run is None:
+            return
+        self.update(finished=time.time(), outcome=outcome)
+        if not done:
+            return
+        if self.enabled:
+            self.prune()
+        self._run = None
+        try:
+            self.journal.pop("history")
+            if not self.journal.data:
+                self.journal.clear()
+        except (DlmEngineJournalError, OSError) as err:
+            self.log.warning(f"could not drop history run id: {err}")
+
+    def prune(self):
+        try:
+            self.db.execute(
+                "DELETE FROM runs WHERE started < ?",
+                (time.time() - self._retention * 86400,),
+            )
+            # checks without updates are kept apart, they would push the update runs out
+            for no_updates in [True, False]:
+                self.db.execute(
+                    "DELETE FROM runs WHERE (IFNULL(outcome, '') = 'no_updates') = ? "
+                    "AND run_id NOT IN (SELECT run_id FROM runs "
+                    "WHERE (IFNULL(outcome, '') = 'no_updates') = ? ORDER BY started DESC LIMIT ?)",
+                    (no_updates, no_updates, self._max_runs),
+                )
+            for table in ["phases", "scripts"]:
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE run_id NOT IN (SELECT run_id FROM runs)"
+                )
+            self.db.commit()
+        except sqlite3.Error as err:
+            self.log.warning(f"could not prune run history: {err}")
+
+    def reset(self):
+        self._run = None
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def _stats(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return f"{0:6d} {'-':>9} {'-':>9} {'-':>9} {'-':>9}"
+    return (
+        f"{len(values):6d} {percentile(values, 50):9.2f} {percentile(values, 90):9.2f} "
+        f"{percentile(values, 99):9.2f} {max(values):9.2f}"
+    )
+
+
+def report(path, runs=100, top=10):
+    """percentiles over the last runs, used by the history command"""
+    if not os.path.exists(path):
+        print(f"no run history found at {path}")
+        return 1
+    db = connect(path)
+    rows = db.execute(
+        "SELECT run_id, started, finished, outcome, lock_wait, lock_acquired, "
+        "lock_released, reboot_duration FROM runs ORDER BY started DESC LIMIT ?",
+        (runs,),
+    ).fetchall()
+    if not rows:
+        print("no runs recorded")
+        db.close()
+        return 0
+    run_ids = [row[0] for row in rows]
+    marks = ", ".join("?" for _ in run_ids)
+    outcomes = dict()
+    for row in rows:
+        outcome = row[3] or "unknown"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print(
+        f"last {len(rows)} runs: "
+        + ", ".join(f"{outcome} {count}" for outcome, count in sorted(outcomes.items()))
+    )
+    header = f"{'count':>6} {'p50 s':>9} {'p90 s':>9} {'p99 s':>9} {'max s':>9}"
+
+    print()
+    print(f"{'':24} {header}")
+    print(f"{'run duration':24} {_stats([r[2] - r[1] for r in rows if r[2] and r[1]])}")
+    print(f"{'lock wait':24} {_stats([r[4] for r in rows])}")
+    print(f"{'lock hold':24} {_stats([r[6] - r[5] for r in rows if r[5] and r[6]])}")
+    print(f"{'reboot':24} {_stats([r[7] for r in rows])}")
+    phases = dict()
+    for phase, duration in db.execute(
+        f"SELECT phase, duration FROM phases WHERE run_id IN ({marks})", run_ids
+    ):
+        phases.setdefault(phase, list()).append(duration)
+    for phase, durations in sorted(phases.items()):
+        print(f"{'phase ' + phase:24} {_stats(durations)}")
+
+    scripts = dict()
+    failures = dict()
+    cpu = dict()
+    rss = dict()
+    for phase, script, duration, return_code, cpu_user, cpu_system, max_rss in db.execute(
+        "SELECT phase, script, duration, return_code, cpu_user, cpu_system, max_rss "
+        f"FROM scripts WHERE run_id IN ({marks})",
+        run_ids,
+    ):
+        scripts.setdefault((phase, script), list()).append(duration)
+        if cpu_user is not None:
+            cpu.setdefault((phase, script), list()).append(cpu_user + cpu_system)
+        if max_rss is not None:
+            rss[(phase, script)] = max(rss.get((phase, script), 0), max_rss)
+        # a non zero return code is the expected answer of these phases
+        if return_code and phase not in ("needs_update", "needs_reboot"):
+            failures[(phase, script)] = failures.get((phase, script), 0) + 1
+    slowest = sorted(scripts.items(), key=lambda x: percentile(x[1], 90), reverse=True)
+    print()
+    print(f"{header} {'failed':>6} {'cpu p90 s':>9} {'rss MiB':>8} slowest scripts")
+    for key, durations in slowest[:top]:
+        _cpu = f"{percentile(cpu[key], 90):9.2f}" if key in cpu else f"{'-':>9}"
+        _rss = f"{rss[key] / 1024:8.1f}" if key in rss else f"{'-':>8}"
+        print(f"{_stats(durations)} {failures.get(key, 0):6d} {_cpu} {_rss} {key[0]} {key[1]}")
+    db.close()
+    return 0
@@ -1,11 +1,14 @@
 import random
 import socket
 import sys
+import threading
 import time
 
-import httpx
-
 from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.trace import SPAN_KIND_CLIENT
+
+# longest queue long poll of an acquisition in the background, it can be cancelled any time
+QUEUE_POLL_PENDING = 5
 
 
 class DlmEngineLock:
@@ -20,6 +23,10 @@ class DlmEngineLock:
         wait,
         wait_max,
         noop,
+        tracer=None,
+        queue=False,
+        priority=50,
+        queue_poll=30,
     ):
         self._ca = ca
         self._endpoint = endpoint
@@ -31,11 +38,41 @@ class DlmEngineLock:
         self._wait_max = wait_max
         self._noop = noop
         self._log = log
+        self._attempts = 0
+        self._waited = 0.0
+        self._acquired_at = None
+        self._tracer = tracer
+        self._cancel = threading.Event()
+        self._thread = None
+        self._result = None
+        self._queue = queue
+        self._priority = priority
+        self._queue_poll = queue_poll
+        self._position = None
+        self._on_position = None
+        self._ticket = None
 
     @property
     def log(self) -> DlmLogger:
         return self._log
 
+    @property
+    def tracer(self):
+        return self._tracer
+
+    def _request(self, method, **kwargs):
+        if not self.tracer:
+            return self.dlm_api.request(method=method, **kwargs)
+        with self.tracer.span(
+            f"dlm_lock {method}",
+            attributes={"http.request.method": method, "url.full": kwargs.get("url")},
+            kind=SPAN_KIND_CLIENT,
+        ) as span:
+            resp = self.dlm_api.request(method=method, **kwargs)
+            if span:
+                span.attributes["http.response.status_code"] = resp.status_code
+            return resp
+
     @property
     def ca(self):
         return self._ca
@@ -55,6 +92,9 @@ class DlmEngineLock:
     @property
     def dlm_api(self):
         if not self._dlm_api:
+            # httpx is slow to import, noop mode and early exits never need it
+            import httpx
+
             self._dlm_api = httpx.Client(
                 verify=self.ca,
                 headers={
@@ -64,6 +104,11 @@ class DlmEngineLock:
             )
         return self._dlm_api
 
+    def close(self):
+        if self._dlm_api:
+            self._dlm_api.close()
+            self._dlm_api = None
+
     @property
     def lock_name(self):
         return self._lock_name
@@ -84,21 +129,147 @@ class DlmEngineLock:
     def wait_max(self):
         return self._wait_max
 
+    @property
+    def attempts(self):
+        return self._attempts
+
+    @property
+    def waited(self):
+        return self._waited
+
+    @property
+    def acquired_at(self):
+        return self._acquired_at
+
+    @property
+    def pending(self):
+        return self._thread is not None
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def position(self):
+        """position of the queue ticket, 0 is the head, None if not queued"""
+        return self._position
+
+    @property
+    def on_position(self):
+        return self._on_position
+
+    @on_position.setter
+    def on_position(self, value):
+        self._on_position = value
+
+    def _position_set(self, position):
+        if position == self._position:
+            return
+        self._position = position
+        if position is not None:
+            self.log.info(
+                f"queue position {position} for {self.lock_name}, priority {self.priority}",
+                phase="lock_get",
+            )
+        if self.on_position:
+            self.on_position(position)
+
     @property
     def lock_url(self):
         return f"{self.endpoint}locks/{self.lock_name}"
 
-    def acquire(self):
+    @property
+    def queue_url(self):
+        return f"{self.endpoint}queues/{self.lock_name}"
+
+    def acquire(self, deadline=None):
+        """
+        returns True once the lock is acquired, False if waiting for it was
+        cut off because the next attempt would start after deadline.
+        """
+        self._attempts = 0
+        self._waited = 0.0
+        self._acquired_at = None
         if self.noop:
             self.log.info("noop mode acquire", phase="lock_get")
+            self._acquired_at = time.time()
+            return True
+        start = time.monotonic()
+        try:
+            acquired = self._acquire_wait(deadline)
+        finally:
+            self._waited = time.monotonic() - start
+        if acquired:
+            self._acquired_at = time.time()
+        return acquired
+
+    def acquire_start(self, deadline=None):
+        """start acquire() in the background, see acquire_join and acquire_cancel"""
+        self._cancel.clear()
+        self._result = None
+        parent_id = None
+        if self.tracer and self.tracer.enabled:
+            parent_id = self.tracer.current_span_id
+        self._thread = threading.Thread(
+            target=self._acquire_background,
+            args=(deadline, parent_id),
+            name="dlm-lock-acquire",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _acquire_background(self, deadline, parent_id):
+        try:
+            if parent_id:
+                with self.tracer.parent(parent_id):
+                    self._result = self.acquire(deadline)
+            else:
+                self._result = self.acquire(deadline)
+        except SystemExit:
+            self._result = None
+        except Exception as err:
+            self.log.error(f"could not acquire lock: {err}", phase="lock_get")
+            self._result = None
+
+    def acquire_join(self):
+        """wait for the background acquire(), exit like acquire() does on errors"""
+        self._thread.join()
+        self._thread = None
+        if self._result is None:
+            sys.exit(1)
+        return self._result
+
+    def acquire_cancel(self):
+        """stop the background acquire(), release the lock if it was already acquired"""
+        if self._thread is None:
             return
+        self._cancel.set()
+        ticket = self._ticket
+        if ticket is not None:
+            # leaving the queue answers the long poll of the thread, it would block for queue_poll
+            self._dequeue(ticket)
+        self._thread.join()
+        self._thread = None
+        if self._result:
+            self.log.info("releasing lock acquired in the background", phase="lock_get")
+            self.release()
+
+    def _acquire_wait(self, deadline=None):
         self.log.debug(f"waiting is set to {self.wait}", phase="lock_get")
         self.log.debug(f"max wait time is set to {self.wait_max}", phase="lock_get")
         if self.wait:
+            if self.queue:
+                acquired = self._acquire_queue(deadline)
+                if acquired is not None:
+                    return acquired
             _waited = 0
             while True:
                 if self._acquire():
-                    return
+                    return True
                 else:
                     if _waited > self.wait_max:
                         self.log.error(
@@ -106,20 +277,141 @@ class DlmEngineLock:
                         )
                         sys.exit(1)
                     _sleep = random.randint(10, 60)
+                    if deadline and time.time() + _sleep > deadline:
+                        self.log.warning(
+                            "deadline reached while waiting for the lock", phase="lock_get"
+                        )
+                        return False
                     _waited += _sleep + 2
                     self.log.error(f"sleeping {_sleep} seconds", phase="lock_get")
-                    time.sleep(_sleep)
+                    if self._cancel.wait(_sleep):
+                        self.log.info("waiting for the lock cancelled", phase="lock_get")
+                        return False
         else:
             if not self._acquire():
                 self.log.error("quiting", phase="lock_get")
                 sys.exit(1)
+            return True
+
+    def _enqueue(self):
+        """returns the ticket, None if the api has no queue extension"""
+        import httpx
+
+        try:
+            resp = self._request(
+                "POST",
+                json={**self.payload_acquire, "priority": self.priority},
+                timeout=10.0,
+                url=self.queue_url,
+            )
+        except httpx.HTTPError as err:
+            self.log.error(f"could not enqueue, polling instead: {err}", phase="lock_get")
+            return None
+        if resp.status_code != 201:
+            self.log.warning(
+                f"lock queue not available (http {resp.status_code}), polling instead",
+                phase="lock_get",
+            )
+            return None
+        ticket = resp.json()
+        self.log.info(f"enqueued with ticket {ticket['ticket']}", phase="lock_get")
+        self._position_set(ticket.get("position"))
+        return ticket["ticket"]
+
+    def _watch(self, ticket, wait):
+        """
+        position of ticket once it changed or wait seconds passed, None if the
+        ticket is gone. raises httpx.HTTPError.
+        """
+        resp = self._request(
+            "GET",
+            params={"wait": int(wait), "position": -1 if self.position is None else self.position},
+            timeout=wait + 10.0,
+            url=f"{self.queue_url}/{ticket}",
+        )
+        if resp.status_code != 200:
+            return None
+        return resp.json()["position"]
+
+    def _dequeue(self, ticket):
+        import httpx
+
+        try:
+            self._request("DELETE", timeout=10.0, url=f"{self.queue_url}/{ticket}")
+        except httpx.HTTPError as err:
+            self.log.warning(f"could not leave the lock queue: {err}", phase="lock_get")
+
+    def _acquire_queue(self, deadline=None):
+        """
+        wait for the lock in the queue of the api. returns True once acquired,
+        False if cut off by deadline or cancelled, None to fall back to polling.
+        """
+        import httpx
+
+        if self._acquire():
+            return True
+        ticket = self._ticket = self._enqueue()
+        if ticket is None:
+            return None
+        start = time.monotonic()
+        acquired = False
+        try:
+            while True:
+                if self._cancel.is_set():
+                    self.log.info("waiting for the lock cancelled", phase="lock_get")
+                    return False
+                if time.monotonic() - start > self.wait_max:
+                    self.log.error("exceeded max wait time, quiting", phase="lock_get")
+                    sys.exit(1)
+                wait = self._queue_poll
+                if self.pending:
+                    # cancelled in the background when there are no updates, do not block the run
+                    wait = min(wait, QUEUE_POLL_PENDING)
+                if deadline:
+                    if time.time() >= deadline:
+                        self.log.warning(
+                            "deadline reached while waiting for the lock", phase="lock_get"
+                        )
+                        return False
+                    wait = max(1, min(wait, deadline - time.time()))
+                try:
+                    position = self._watch(ticket, wait)
+                except httpx.HTTPError as err:
+                    self.log.error(f"request error, retrying: {err}", phase="lock_get")
+                    self._cancel.wait(random.randint(10, 60))
+                    continue
+                if self._cancel.is_set():
+                    self.log.info("waiting for the lock cancelled", phase="lock_get")
+                    return False
+                if position is None:
+                    self.log.warning("queue ticket expired, enqueueing again", phase="lock_get")
+                    self._position = None
+                    ticket = self._ticket = self._enqueue()
+                    if ticket is None:
+                        return None
+                    continue
+                self._position_set(position)
+                if position == 0:
+                    acquired = self._acquire()
+                    if acquired:
+                        return True
+                    # the lock is still held, the head waits for the release
+        finally:
+            self._ticket = None
+            if not acquired:
+                self._dequeue(ticket)
+            self._position_set(None)
 
     def _acquire(self):
+        import httpx
+
+        self._attempts += 1
         self.log.info(f"trying to acquire: {self.lock_url}", phase="lock_get")
         if self._acquire_check():
             return True
         try:
-            resp = self.dlm_api.post(
+            resp = self._request(
+                "POST",
                 json=self.payload_acquire,
                 timeout=10.0,
                 url=self.lock_url,
@@ -140,14 +432,15 @@ class DlmEngineLock:
 
     def _acquire_check(self):
         self.log.info("checking if lock has been acquired", phase="lock_get")
-        resp = self.dlm_api.get(
+        resp = self._request(
+            "GET",
             timeout=10.0,
             url=self.lock_url,
         )
         if not resp.status_code == 200:
             self.log.info("lock currently not present in the system", phase="lock_get")
             return None
-        if not resp.json()["acquired_by"] == socket.getfqdn():
+        if not resp.json()["acquired_by"] == self.payload_acquire["acquired_by"]:
             self.log.info(
                 f"lock is currently acquired by {resp.json()['acquired_by']}",
                 phase="lock_get",
@@ -163,12 +456,14 @@ class DlmEngineLock:
         if self.noop:
             self.log.info("noop mode release", phase="lock_release")
             return
+        import httpx
+
         self.log.info(f"trying to release: {self.lock_url}", phase="lock_release")
         retries = 10
         while retries > 0:
             try:
-                resp = self.dlm_api.request(
-                    method="DELETE",
+                resp = self._request(
+                    "DELETE",
                     timeout=10.0,
                     url=self.lock_url,
                 )
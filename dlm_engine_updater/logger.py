@@ -2,6 +2,7 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 import time
 
+from dlm_engine_updater.logindex import DlmEngineIndexedLogHandler
 from dlm_engine_updater.plugin import DlmEnginePluginManager
 from dlm_engine_updater.plugin import PluginHookType
 from dlm_engine_updater.plugin import PluginTiming
@@ -12,11 +13,20 @@ class DlmLogger:
         self,
         config,
         plugin_manager,
+        domain=None,
     ):
         self._config = config
-        self._log = logging.getLogger("application")
+        self._domain = domain
         self._plugin_manager = plugin_manager
-        self._logging()
+        self._run_id = None
+        self._handlers = list()
+        if domain:
+            # domain loggers have no handlers, they propagate to the logger of the coordinator
+            self._log = logging.getLogger(f"application.{domain}")
+            self._log.setLevel(self.config.main.log.level)
+        else:
+            self._log = logging.getLogger("application")
+            self._logging()
 
     @property
     def config(self):
@@ -26,6 +36,14 @@ class DlmLogger:
     def plugin_manager(self) -> DlmEnginePluginManager:
         return self._plugin_manager
 
+    @property
+    def run_id(self):
+        return self._run_id
+
+    @run_id.setter
+    def run_id(self, value):
+        self._run_id = value
+
     def _logging(self):
         logfmt = logging.Formatter(
             "%(asctime)sUTC - %(levelname)s - %(threadName)s - %(message)s"
@@ -35,13 +53,29 @@ class DlmLogger:
         aap_level = self.config.main.log.level
         log = self.config.main.log.file
         retention = self.config.main.log.retention
-        handlers.append(TimedRotatingFileHandler(log, "d", 1, retention))
+        if self.config.main.log.index:
+            handlers.append(DlmEngineIndexedLogHandler(log, "d", 1, retention))
+        else:
+            handlers.append(TimedRotatingFileHandler(log, "d", 1, retention))
 
         for handler in handlers:
             handler.setFormatter(logfmt)
             self._log.addHandler(handler)
+        self._handlers = handlers
         self._log.setLevel(aap_level)
 
+    def index_flush(self):
+        """write the pending segment of the log index, domain loggers share the handler"""
+        for handler in logging.getLogger("application").handlers:
+            if isinstance(handler, DlmEngineIndexedLogHandler):
+                handler.flush_index()
+
+    def close(self):
+        for handler in self._handlers:
+            self._log.removeHandler(handler)
+            handler.close()
+        self._handlers = list()
+
     def log(
         self,
         level,
@@ -49,7 +83,10 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
+        if self._domain:
+            kwargs.setdefault("domain", self._domain)
         self.plugin_manager.run(
             hook_type=PluginHookType.LOGGER,
             timing=PluginTiming.PRE,
@@ -58,8 +95,18 @@ class DlmLogger:
             phase=phase,
             script=script,
             return_code=return_code,
+            **kwargs,
+        )
+        self._log.log(
+            level,
+            f"[{self._domain}] {msg}" if self._domain else msg,
+            extra={
+                "dlm_run_id": self._run_id,
+                "dlm_domain": self._domain,
+                "dlm_phase": phase,
+                "dlm_script": None if script is None else str(script),
+            },
         )
-        self._log.log(level, msg)
         self.plugin_manager.run(
             hook_type=PluginHookType.LOGGER,
             timing=PluginTiming.POST,
@@ -68,6 +115,7 @@ class DlmLogger:
             phase=phase,
             script=script,
             return_code=return_code,
+            **kwargs,
         )
 
     def critical(
@@ -76,8 +124,9 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
-        self.log(logging.CRITICAL, msg, phase, script, return_code)
+        self.log(logging.CRITICAL, msg, phase, script, return_code, **kwargs)
 
     def debug(
         self,
@@ -85,8 +134,9 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
-        self.log(logging.DEBUG, msg, phase, script, return_code)
+        self.log(logging.DEBUG, msg, phase, script, return_code, **kwargs)
 
     def error(
         self,
@@ -94,8 +144,9 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
-        self.log(logging.ERROR, msg, phase, script, return_code)
+        self.log(logging.ERROR, msg, phase, script, return_code, **kwargs)
 
     def fatal(
         self,
@@ -103,8 +154,9 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
-        self.log(logging.fatal, msg, phase, script, return_code)
+        self.log(logging.FATAL, msg, phase, script, return_code, **kwargs)
 
     def info(
         self,
@@ -112,8 +164,9 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
-        self.log(logging.INFO, msg, phase, script, return_code)
+        self.log(logging.INFO, msg, phase, script, return_code, **kwargs)
 
     def warning(
         self,
@@ -121,5 +174,27 @@ class DlmLogger:
         phase="main",
         script=None,
         return_code=None,
+        **kwargs,
     ):
-        self.log(logging.WARNING, msg, phase, script, return_code)
+        self.log(logging.WARNING, msg, phase, script, return_code, **kwargs)
+
+
+class DlmLoggerContext:
+    """DlmLogger bound to the phase and script of an in-process step"""
+
+    def __init__(self, log, phase, script):
+        self._log = log
+        self._phase = phase
+        self._script = script
+
+    def debug(self, msg):
+        self._log.debug(msg, phase=self._phase, script=self._script)
+
+    def info(self, msg):
+        self._log.info(msg, phase=self._phase, script=self._script)
+
+    def warning(self, msg):
+        self._log.warning(msg, phase=self._phase, script=self._script)
+
+    def error(self, msg):
+        self._log.error(msg, phase=self._phase, script=self._script)
@@ -0,0 +1,283 @@
+"""
+sidecar index of the log file, one line per contiguous segment of a run,
+phase and script with the file, byte offset and length it was written to.
+
+the reading side is used by the logs command line, it must only import the
+standard library and modules of this package that do the same.
+"""
+
+import datetime
+import gzip
+import logging
+import os
+import sys
+from logging.handlers import TimedRotatingFileHandler
+
+INDEX_SUFFIX = ".idx"
+FIELDS = ["file", "offset", "length", "started", "ended", "run_id", "domain", "phase", "script"]
+
+
+def _field(value):
+    if value is None:
+        return "-"
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+
+def _value(value):
+    return None if value == "-" else value
+
+
+class DlmEngineIndexedLogHandler(TimedRotatingFileHandler):
+    """
+    TimedRotatingFileHandler that records where each segment of the log
+    went. a segment ends when the run, domain, phase or script of a record
+    changes, the index is compacted to the rotated file names on rollover.
+    """
+
+    def __init__(self, filename, when="h", interval=1, backupCount=0, **kwargs):
+        super().__init__(filename, when, interval, backupCount, **kwargs)
+        self._index = self.baseFilename + INDEX_SUFFIX
+        self._segment = None
+        self._rotated = None
+
+    @property
+    def index(self):
+        return self._index
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            msg = self.format(record) + self.terminator
+            key = (
+                getattr(record, "dlm_run_id", None),
+                getattr(record, "dlm_domain", None),
+                getattr(record, "dlm_phase", None),
+                getattr(record, "dlm_script", None),
+            )
+            if self._segment is None or self._segment["key"] != key:
+                self._flush()
+                # the file size once per segment, records of a segment are counted
+                start = os.fstat(self.stream.fileno()).st_size
+                self._segment = {
+                    "key": key,
+                    "start": start,
+                    "end": start,
+                    "started": record.created,
+                    "ended": record.created,
+                }
+            self.stream.write(msg)
+            self.flush()
+            self._segment["end"] += len(msg.encode(self.stream.encoding, self.stream.errors))
+            self._segment["ended"] = record.created
+        except Exception:
+            self.handleError(record)
+
+    def _flush(self):
+        segment, self._segment = self._segment, None
+        if not segment:
+            return
+        fields = [
+            os.path.basename(self.baseFilename),
+            segment["start"],
+            segment["end"] - segment["start"],
+            f"{segment['started']:.3f}",
+            f"{segment['ended']:.3f}",
+        ] + list(segment["key"])
+        with open(self.index, "a") as index:
+            index.write("\t".join(_field(field) for field in fields) + "\n")
+
+    def flush_index(self):
+        """write the pending segment, the process may be gone before the next one starts"""
+        self.acquire()
+        try:
+            self._flush()
+        finally:
+            self.release()
+
+    def rotate(self, source, dest):
+        super().rotate(source, dest)
+        self._rotated = (os.path.basename(source), os.path.basename(dest))
+
+    def doRollover(self):
+        self._flush()
+        self._rotated = None
+        super().doRollover()
+        if self._rotated:
+            self._compact(*self._rotated)
+
+    def _compact(self, source, dest):
+        """point the segments of the rotated file to its new name, drop segments of deleted files"""
+        directory = os.path.dirname(self.baseFilename)
+        lines = list()
+        try:
+            with open(self.index, "r") as index:
+                for line in index:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != len(FIELDS) or fields[0] == dest:
+                        # a backup of the same name was overwritten
+                        continue
+                    if fields[0] == source:
+                        fields[0] = dest
+                    path = os.path.join(directory, fields[0])
+                    if not (os.path.exists(path) or os.path.exists(path + ".gz")):
+                        continue
+                    lines.append("\t".join(fields) + "\n")
+            temp = f"{self.index}.{os.getpid()}"
+            with open(temp, "w") as index:
+                index.writelines(lines)
+            os.replace(temp, self.index)
+        except OSError as err:
+            sys.stderr.write(f"could not compact log index {self.index}: {err}\n")
+
+    def close(self):
+        self.flush_index()
+        super().close()
+
+
+def segments(index):
+    """segments of the index file as dicts, in the order they were written"""
+    with open(index, "r") as _index:
+        for line in _index:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(FIELDS):
+                continue
+            segment = {field: _value(value) for field, value in zip(FIELDS, fields)}
+            segment["offset"] = int(segment["offset"])
+            segment["length"] = int(segment["length"])
+            segment["started"] = float(segment["started"])
+            segment["ended"] = float(segment["ended"])
+            yield segment
+
+
+def _moment(value):
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def _outcomes(history):
+    """outcome by run id from the run history, empty without history"""
+    if not history or not os.path.exists(history):
+        return dict()
+    import sqlite3
+
+    try:
+        db = sqlite3.connect(f"file:{history}?mode=ro", uri=True)
+        try:
+            return dict(db.execute("SELECT run_id, outcome FROM runs"))
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return dict()
+
+
+class _Reader:
+    """open log files by name, rotated files may have been compressed since"""
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._files = dict()
+
+    def read(self, name, offset, length):
+        if name not in self._files:
+            path = os.path.join(self._directory, name)
+            if os.path.exists(path):
+                self._files[name] = open(path, "rb")
+            elif os.path.exists(path + ".gz"):
+                self._files[name] = gzip.open(path + ".gz", "rb")
+            else:
+                self._files[name] = None
+        _file = self._files[name]
+        if _file is None:
+            return None
+        _file.seek(offset)
+        return _file.read(length)
+
+    def close(self):
+        for _file in self._files.values():
+            if _file:
+                _file.close()
+
+
+def show(
+    log_file,
+    history=None,
+    run_id=None,
+    last=1,
+    outcome=None,
+    phase=None,
+    script=None,
+    domain=None,
+    list_runs=False,
+):
+    """print the segments of one run, used by the logs command"""
+    index = log_file + INDEX_SUFFIX
+    if not os.path.exists(index):
+        print(f"no log index found at {index}")
+        return 1
+    outcomes = _outcomes(history)
+
+    def matches(segment):
+        if domain and segment["domain"] != domain:
+            return False
+        if phase and segment["phase"] != phase:
+            return False
+        return not script or (segment["script"] and script in segment["script"])
+
+    # first pass, runs with their time range and phases
+    runs = dict()
+    for segment in segments(index):
+        if not segment["run_id"] or not matches(segment):
+            continue
+        run = runs.setdefault(
+            segment["run_id"],
+            {"started": segment["started"], "ended": segment["ended"], "phases": list(), "bytes": 0},
+        )
+        run["started"] = min(run["started"], segment["started"])
+        run["ended"] = max(run["ended"], segment["ended"])
+        run["bytes"] += segment["length"]
+        if segment["phase"] not in run["phases"]:
+            run["phases"].append(segment["phase"])
+    selected = [
+        (key, run)
+        for key, run in sorted(runs.items(), key=lambda x: x[1]["started"], reverse=True)
+        if (not run_id or key.startswith(run_id))
+        and (not outcome or outcomes.get(key) == outcome)
+    ]
+    if list_runs:
+        for key, run in reversed(selected):
+            print(
+                f"{key} {_moment(run['started'])} {_moment(run['ended'])} "
+                f"{outcomes.get(key) or '-':12} {run['bytes']:9d} {','.join(run['phases'])}"
+            )
+        return 0
+    if len(selected) < last:
+        print("no matching run found in the log index")
+        return 1
+    selected_id = selected[last - 1][0]
+
+    # second pass, segments of the selected run
+    found = sorted(
+        (
+            segment
+            for segment in segments(index)
+            if segment["run_id"] == selected_id and matches(segment)
+        ),
+        key=lambda x: (x["started"], x["file"], x["offset"]),
+    )
+    reader = _Reader(os.path.dirname(os.path.abspath(log_file)))
+    out = sys.stdout.buffer
+    try:
+        for segment in found:
+            data = reader.read(segment["file"], segment["offset"], segment["length"])
+            if data is None:
+                out.write(f"log file {segment['file']} is gone\n".encode())
+                continue
+            out.write(data)
+        out.flush()
+    finally:
+        reader.close()
+    return 0
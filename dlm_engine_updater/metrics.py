@@ -0,0 +1,132 @@
+import json
+import os
+import time
+
+from dlm_engine_updater.logger import DlmLogger
+
+PROM_FILE = "dlm_engine_updater.prom"
+
+METRICS = {
+    "phase_duration_seconds": "Duration of the last execution of an update phase.",
+    "script_duration_seconds": "Duration of the last execution of a phase script.",
+    "script_exit_code": "Exit code of the last execution of a phase script.",
+    "lock_wait_seconds": "Time spent waiting for the distributed lock in the last run.",
+    "lock_acquire_attempts": "Number of lock acquire attempts in the last run.",
+    "lock_hold_seconds": "Time the distributed lock was held in the last run.",
+    "notifier_duration_seconds": "Time spent in ext_notify scripts in the last run.",
+    "last_success_timestamp_seconds": "Unix time of the last successful update run.",
+    "last_run_timestamp_seconds": "Unix time the updater last ran.",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class DlmEngineMetrics:
+    """
+    node_exporter textfile collector metrics. a run can span several
+    processes (reboot, retries), the values are kept in a json file in
+    basedir and the prom file is rendered from it on every write.
+    """
+
+    def __init__(self, log, directory, path, lock_name, prom_file=PROM_FILE):
+        self._log = log
+        self._directory = directory
+        self._prom_file = prom_file
+        self._path = path
+        self._lock_name = lock_name
+        self._data = None
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def lock_name(self):
+        return self._lock_name
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            try:
+                with open(self.path, "r") as metrics:
+                    self._data = json.load(metrics)
+            except (OSError, ValueError):
+                self._data = dict()
+        return self._data
+
+    def _set(self, metric, value, **labels):
+        key = json.dumps(sorted(labels.items()))
+        self.data.setdefault(metric, dict())[key] = value
+
+    def run_start(self):
+        """drop the series of the previous run, keep the timestamps"""
+        for metric in list(self.data):
+            if not metric.endswith("_timestamp_seconds"):
+                del self.data[metric]
+
+    def phase(self, phase, duration):
+        self._set("phase_duration_seconds", duration, phase=phase)
+
+    def script(self, phase, script, duration, return_code):
+        self._set("script_duration_seconds", duration, phase=phase, script=script)
+        self._set("script_exit_code", return_code, phase=phase, script=script)
+
+    def lock_wait(self, duration, attempts):
+        self._set("lock_wait_seconds", duration)
+        self._set("lock_acquire_attempts", attempts)
+
+    def lock_hold(self, duration):
+        self._set("lock_hold_seconds", duration)
+
+    def notifier(self, duration):
+        current = self.data.get("notifier_duration_seconds", {}).get("[]", 0)
+        self._set("notifier_duration_seconds", current + duration)
+
+    def success(self):
+        self._set("last_success_timestamp_seconds", time.time())
+
+    def render(self):
+        lines = list()
+        for metric, help_text in METRICS.items():
+            series = self.data.get(metric)
+            if not series:
+                continue
+            name = f"dlm_engine_updater_{metric}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in sorted(series.items()):
+                labels = [("lockname", self.lock_name)] + [tuple(x) for x in json.loads(key)]
+                labels = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        self._set("last_run_timestamp_seconds", time.time())
+        try:
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as metrics:
+                json.dump(self.data, metrics)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            self.log.warning(f"could not save metrics: {err}")
+        if not self.directory:
+            return
+        prom = os.path.join(self.directory, self._prom_file)
+        # node_exporter only reads *.prom, the temporary file is ignored
+        tmp = os.path.join(self.directory, f".{self._prom_file}.{os.getpid()}")
+        try:
+            with open(tmp, "w") as metrics:
+                metrics.write(self.render())
+            os.replace(tmp, prom)
+        except OSError as err:
+            self.log.warning(f"could not write metrics to {prom}: {err}")
@@ -2,9 +2,11 @@ from enum import Enum
 import importlib
 import sys
 from typing import Any
+from typing import TYPE_CHECKING
 
-from dlm_engine_updater.config import DlmUpdaterConfig
-from dlm_engine_updater.config import DlmUpdaterConfigMainPlugin
+if TYPE_CHECKING:
+    from dlm_engine_updater.config import DlmUpdaterConfig
+    from dlm_engine_updater.config import DlmUpdaterConfigMainPlugin
 
 
 class PluginHookType(Enum):
@@ -21,10 +23,48 @@ class DlmEnginePluginError(Exception):
     pass
 
 
+class DlmEngineStep:
+    """
+    in-process counterpart of a script in a phase directory.
+
+    steps are ordered by name together with the scripts of the phase and
+    run with the same return code semantics, 0 is success (or "no updates",
+    "no reboot needed"), anything else is failure (or "updates available",
+    "reboot needed"). None counts as 0, an exception as 1.
+    """
+
+    def __init__(self, name: str, phases: list):
+        self._name = name
+        self._phases = phases
+        self._plugin = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def phases(self):
+        return self._phases
+
+    @property
+    def plugin(self):
+        return self._plugin
+
+    @plugin.setter
+    def plugin(self, plugin):
+        self._plugin = plugin
+
+    def __str__(self):
+        return f"{self.plugin}:{self.name}"
+
+    def run(self, phase: str, log, **kwargs: Any) -> int:
+        raise NotImplementedError
+
+
 class DlmEnginePluginBase:
     def __init__(
         self,
-        config: DlmUpdaterConfigMainPlugin,
+        config: "DlmUpdaterConfigMainPlugin",
     ):
         self._config = config
         self._log = None
@@ -64,6 +104,10 @@ class DlmEnginePluginBase:
         # do not use self.log here, it will cause a recursion loop
         pass
 
+    def steps(self) -> list:
+        """DlmEngineStep instances this plugin adds to the phases"""
+        return list()
+
     def phase_pre_hook(
         self,
         phase: str,
@@ -82,10 +126,11 @@ class DlmEnginePluginBase:
 class DlmEnginePluginManager:
     def __init__(
         self,
-        config: DlmUpdaterConfig,
+        config: "DlmUpdaterConfig",
     ):
         self._config = config
         self._log = None
+        self._tracer = None
         self._plugins = dict()
         self._init()
 
@@ -103,6 +148,14 @@ class DlmEnginePluginManager:
         for plugin in self._plugins.values():
             plugin.log = log
 
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self._tracer = tracer
+
     @property
     def plugins(self):
         return self._plugins
@@ -130,17 +183,34 @@ class DlmEnginePluginManager:
             plugin.init()
             self.log.info(f"Plugin {plugin_name} initialized")
 
+    def steps(self, phase: str):
+        steps = list()
+        for plugin_name, plugin in self._plugins.items():
+            try:
+                plugin_steps = plugin.steps()
+            except Exception as err:
+                self.log.error(f"Error in plugin {plugin_name} steps: {err}", phase=phase)
+                continue
+            for step in plugin_steps:
+                if phase in step.phases:
+                    step.plugin = plugin_name
+                    steps.append(step)
+        return steps
+
     def run(
         self,
         hook_type: PluginHookType,
         timing: PluginTiming,
         phase: str = None,
+        tracer=None,
         **kwargs
     ):
         if hook_type == PluginHookType.LOGGER:
             return self._run_logger_hooks(timing=timing, phase=phase, **kwargs)
         elif hook_type == PluginHookType.PHASE:
-            return self._run_phase_hooks(timing=timing, phase=phase, **kwargs)
+            return self._run_phase_hooks(
+                timing=timing, phase=phase, tracer=tracer, **kwargs
+            )
         return None
 
     def _run_logger_hooks(
@@ -176,22 +246,36 @@ class DlmEnginePluginManager:
             except Exception:
                 pass
 
-    def _run_phase_hooks(self, timing: PluginTiming, phase: str, **kwargs):
+    def _run_phase_hooks(self, timing: PluginTiming, phase: str, tracer=None, **kwargs):
+        # update domains share the plugin manager, each passes its own tracer
+        tracer = tracer or self.tracer
         success = True
         for plugin_name, plugin in self._plugins.items():
-            try:
-                if timing == PluginTiming.PRE:
-                    if not plugin.phase_pre_hook(phase, **kwargs):
-                        self.log.warning(
-                            f"Plugin {plugin_name} prevented phase {phase} execution"
-                        )
+            if tracer:
+                with tracer.span(
+                    f"plugin {plugin_name} phase_{timing.value}_hook",
+                    attributes={"dlm.phase": phase, "dlm.plugin": plugin_name},
+                ):
+                    if not self._run_phase_hook(plugin_name, plugin, timing, phase, **kwargs):
                         success = False
-                else:
-                    if not plugin.phase_post_hook(phase, **kwargs):
-                        self.log.warning(
-                            f"Plugin {plugin_name} failed phase {phase} execution"
-                        )
-                        success = False
-            except Exception as err:
-                self.log.error(f"Error in plugin {plugin_name} phase_pre_hook: {err}")
+            elif not self._run_phase_hook(plugin_name, plugin, timing, phase, **kwargs):
+                success = False
         return success
+
+    def _run_phase_hook(self, plugin_name, plugin, timing, phase, **kwargs):
+        try:
+            if timing == PluginTiming.PRE:
+                if not plugin.phase_pre_hook(phase, **kwargs):
+                    self.log.warning(
+                        f"Plugin {plugin_name} prevented phase {phase} execution"
+                    )
+                    return False
+            else:
+                if not plugin.phase_post_hook(phase, **kwargs):
+                    self.log.warning(
+                        f"Plugin {plugin_name} failed phase {phase} execution"
+                    )
+                    return False
+        except Exception as err:
+            self.log.error(f"Error in plugin {plugin_name} phase_pre_hook: {err}")
+        return True
@@ -0,0 +1,156 @@
+import collections
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+from dlm_engine_updater.logger import DlmLogger
+
+PROFILE_MODES = ["deterministic", "sampling"]
+
+
+class DlmEngineSampler:
+    """
+    low overhead sampling profiler, records the stack of one thread every
+    interval seconds and counts identical stacks.
+    """
+
+    def __init__(self, thread_id, interval):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name="dlm-profile-sampler", daemon=True
+        )
+
+    @property
+    def stacks(self) -> collections.Counter:
+        return self._stacks
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class DlmEngineProfiler:
+    def __init__(self, log, mode, directory, top=10, interval=0.01):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"profile mode must be one of {PROFILE_MODES}")
+        self._log = log
+        self._mode = mode
+        self._directory = directory
+        self._top = top
+        self._interval = interval
+        self._run_directory = None
+        self._count = 0
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def top(self):
+        return self._top
+
+    @property
+    def run_directory(self):
+        if not self._run_directory:
+            stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+            self._run_directory = os.path.join(
+                self._directory, f"{stamp}-{os.getpid()}"
+            )
+            os.makedirs(self._run_directory, exist_ok=True)
+        return self._run_directory
+
+    def _artifact(self, phase, suffix):
+        self._count += 1
+        return os.path.join(self.run_directory, f"{self._count:02d}-{phase}.{suffix}")
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        if self.mode == "sampling":
+            sampler = DlmEngineSampler(threading.get_ident(), self._interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self._sampling_report(phase, sampler.stacks)
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self._deterministic_report(phase, profile)
+
+    def _deterministic_report(self, phase, profile):
+        try:
+            path = self._artifact(phase, "pstats")
+            profile.dump_stats(path)
+        except OSError as err:
+            self.log.warning(f"could not write profile: {err}", phase=phase)
+            return
+        stats = pstats.Stats(profile).stats
+        total = sum(tt for _, _, tt, _, _ in stats.values())
+        self.log.info(
+            f"profile of phase {phase}: {total:.3f}s in {len(stats)} functions, written to {path}",
+            phase=phase,
+        )
+        ranked = sorted(stats.items(), key=lambda x: x[1][3], reverse=True)
+        for (filename, line, func), (_, calls, own, cumulative, _) in ranked[: self.top]:
+            self.log.info(
+                f"profile {cumulative:8.3f}s cum {own:8.3f}s own {calls:8d} calls "
+                f"{os.path.basename(filename)}:{line}({func})",
+                phase=phase,
+            )
+
+    def _sampling_report(self, phase, stacks):
+        try:
+            path = self._artifact(phase, "folded")
+            with open(path, "w") as folded:
+                for stack, count in stacks.most_common():
+                    folded.write(f"{stack} {count}\n")
+        except OSError as err:
+            self.log.warning(f"could not write profile: {err}", phase=phase)
+            return
+        samples = sum(stacks.values())
+        self.log.info(
+            f"profile of phase {phase}: {samples} samples, written to {path}",
+            phase=phase,
+        )
+        if not samples:
+            return
+        inclusive = collections.Counter()
+        for stack, count in stacks.items():
+            for func in set(stack.split(";")):
+                inclusive[func] += count
+        for func, count in inclusive.most_common(self.top):
+            self.log.info(
+                f"profile {count / samples:7.1%} of samples in {func}", phase=phase
+            )
@@ -0,0 +1,148 @@
+import os
+import resource
+
+from dlm_engine_updater.logger import DlmLogger
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_CONTROLLERS = ["cpu", "memory", "io"]
+
+
+def rusage_dict(rusage):
+    """the parts of a struct rusage that are reported per script"""
+    return {
+        "cpu_user": rusage.ru_utime,
+        "cpu_system": rusage.ru_stime,
+        "max_rss": rusage.ru_maxrss,
+        "block_in": rusage.ru_inblock,
+        "block_out": rusage.ru_oublock,
+        "ctx_voluntary": rusage.ru_nvcsw,
+        "ctx_involuntary": rusage.ru_nivcsw,
+    }
+
+
+def rusage_delta(before, after):
+    """usage of the current thread between two RUSAGE_THREAD samples, for in-process steps"""
+    delta = {key: after[key] - before[key] for key in before}
+    # max rss of the whole process says nothing about a single step
+    delta["max_rss"] = None
+    return delta
+
+
+def rusage_thread():
+    return rusage_dict(resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)))
+
+
+def rusage_format(usage):
+    text = (
+        f"cpu {usage['cpu_user']:.2f}s user {usage['cpu_system']:.2f}s system, "
+        f"block io {usage['block_in']} in {usage['block_out']} out, "
+        f"context switches {usage['ctx_voluntary']} voluntary {usage['ctx_involuntary']} involuntary"
+    )
+    if usage["max_rss"] is not None:
+        text += f", max rss {usage['max_rss']} KiB"
+    return text
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class DlmEngineCgroup:
+    """
+    cgroup v2 for the scripts of the updater. children move themselves into
+    the cgroup through a shell wrapper before exec, if the cgroup cannot be
+    set up scripts run without limits.
+    """
+
+    def __init__(self, log, path, cpu_weight=None, memory_max=None, io_weight=None):
+        self._log = log
+        self._path = path
+        self._limits = dict()
+        if cpu_weight:
+            self._limits["cpu.weight"] = str(cpu_weight)
+        if memory_max:
+            self._limits["memory.max"] = str(memory_max)
+        if io_weight:
+            self._limits["io.weight"] = f"default {io_weight}"
+        self._available = None
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def available(self):
+        if self._available is None:
+            self._available = self._setup()
+        return self._available
+
+    def _setup(self):
+        if not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+            self.log.warning("cgroup v2 is not available, running scripts without limits")
+            return False
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            parent = os.path.dirname(self.path)
+            with open(os.path.join(parent, "cgroup.controllers"), "r") as controllers:
+                available = controllers.read().split()
+            enable = [c for c in CGROUP_CONTROLLERS if c in available]
+            with open(os.path.join(parent, "cgroup.subtree_control"), "w") as control:
+                control.write(" ".join(f"+{c}" for c in enable))
+        except OSError as err:
+            self.log.warning(f"could not set up cgroup {self.path}, running scripts without limits: {err}")
+            return False
+        for name, value in self._limits.items():
+            try:
+                with open(os.path.join(self.path, name), "w") as limit:
+                    limit.write(value)
+            except OSError as err:
+                self.log.warning(f"could not set {name} of cgroup {self.path}: {err}")
+        self.log.info(f"running scripts in cgroup {self.path}")
+        return True
+
+    def wrap(self, args):
+        """
+        args with a wrapper that writes its pid to cgroup.procs and execs
+        args. a preexec_fn is not safe with the threads of the updater, and
+        writing the pid after the spawn lets early children escape.
+        """
+        if not self.available:
+            return args
+        procs = os.path.join(self.path, "cgroup.procs")
+        return ["/bin/sh", "-c", '{ echo $$ >"$0"; } 2>/dev/null; exec "$@"', procs] + args
+
+    def peak_open(self):
+        """
+        descriptor of memory.peak with a watermark reset for the next
+        script, None if the kernel can not reset it per descriptor (before
+        6.12). the wait status of a script is no help here, its max rss
+        includes the memory of the updater it was forked from.
+        """
+        if not self.available:
+            return None
+        try:
+            fd = os.open(os.path.join(self.path, "memory.peak"), os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            os.write(fd, b"reset\n")
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def peak_read(fd):
+        """peak memory of the cgroup in KiB since peak_open, like ru_maxrss"""
+        try:
+            return int(os.pread(fd, 64, 0)) // 1024
+        except (OSError, ValueError):
+            return None
+        finally:
+            os.close(fd)
@@ -0,0 +1,155 @@
+"""
+cheap checks that run before the configuration, plugins and the http client
+are loaded. only the standard library may be imported here.
+"""
+
+import fcntl
+import os
+import sys
+import threading
+import time
+
+from dlm_engine_updater.constraint import DlmEngineCalendar
+from dlm_engine_updater.constraint import DlmEngineConstraintError
+
+DEFAULT_BASEDIR = "/etc/dlm_engine_updater"
+DEFAULT_LOG_FILE = "/var/log/dlm_engine_updater/dlm_engine_updater.log"
+# states that are entered with the lock held, their history estimates the lock hold duration
+LOCK_HELD_TASKS = [
+    "pre_update",
+    "update",
+    "needs_reboot",
+    "reboot",
+    "post_update",
+    "lock_release",
+]
+
+
+def peek_settings(cfg):
+    """
+    read the top level settings the way pydantic-settings would,
+    environment variables take precedence over the env file.
+    """
+    settings = dict()
+    try:
+        with open(cfg, "r") as env_file:
+            lines = env_file.readlines()
+    except OSError:
+        lines = list()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        if line.startswith("export "):
+            line = line[len("export ") :]
+        key, value = line.split("=", 1)
+        value = value.strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+        settings[key.strip().lower()] = value
+    for key, value in os.environ.items():
+        settings[key.lower()] = value
+    return settings
+
+
+def peek_setting(cfg, name, default=None):
+    return peek_settings(cfg).get(name, default)
+
+
+def peek_basedir(cfg):
+    return peek_setting(cfg, "main_basedir", DEFAULT_BASEDIR)
+
+
+def peek_domains(cfg):
+    """basedir of every enabled update domain, by domain name"""
+    settings = peek_settings(cfg)
+    basedir = settings.get("main_basedir", DEFAULT_BASEDIR)
+    domains = dict()
+    for key in settings:
+        if key.startswith("domain_") and key.count("_") >= 2:
+            name = key.split("_")[1]
+            domains[name] = settings.get(f"domain_{name}_basedir", f"{basedir}/{name}")
+    for name in list(domains):
+        if settings.get(f"domain_{name}_enabled", "true").lower() in ("false", "0", "no", "off"):
+            domains.pop(name)
+    return domains
+
+
+def peek_task(basedir):
+    try:
+        with open(f"{basedir}/state", "r") as state:
+            return state.readline().rstrip("\n")
+    except FileNotFoundError:
+        return "needs_update"
+    except OSError:
+        return None
+
+
+def locked(basedir):
+    try:
+        lock = open(f"{basedir}/lock", "r")
+    except OSError:
+        return False
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    finally:
+        lock.close()
+    return False
+
+
+def log_line(cfg, level, msg):
+    """
+    append msg to the log file in the format of DlmLogger, without logging,
+    plugins and the log index. a log file that can not be written is ignored.
+    """
+    now = time.time()
+    moment = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now))
+    line = f"{moment},{int(now % 1 * 1000):03d}UTC - {level} - {threading.current_thread().name} - {msg}\n"
+    try:
+        with open(peek_setting(cfg, "main_log_file", DEFAULT_LOG_FILE), "a") as log:
+            log.write(line)
+    except OSError:
+        pass
+
+
+def fast_exit(cfg, after_reboot, date_constraint, calendar, blackout, timezone):
+    """
+    exit early if the run would end without doing anything, using the same
+    order as DlmEngineUpdater.work(). everything that is not obviously a no-op
+    is left to the updater.
+    """
+    try:
+        constraints = DlmEngineCalendar.from_args(
+            date_constraint=date_constraint,
+            calendar=calendar,
+            blackout=blackout,
+            timezone=timezone,
+        )
+    except DlmEngineConstraintError:
+        # let the updater report the error
+        return
+    if constraints and not constraints.allowed():
+        msg = "no date constraint matched, exiting"
+        window = constraints.next_window()
+        if window:
+            msg += f", next allowed window starts {window[0].isoformat()}"
+        log_line(cfg, "WARNING", msg)
+        sys.exit(0)
+    basedir = peek_basedir(cfg)
+    if locked(basedir):
+        from dlm_engine_updater.guard import coalesce
+
+        code, msg = coalesce(
+            basedir, after_reboot=after_reboot, wait=int(peek_setting(cfg, "main_guard_wait", "0"))
+        )
+        if code is None:
+            sys.exit(msg)
+        print(msg)
+        sys.exit(code)
+    if after_reboot:
+        basedirs = list(peek_domains(cfg).values()) or [basedir]
+        if not any(peek_task(_basedir) in ("post_update", None) for _basedir in basedirs):
+            log_line(cfg, "INFO", "reboot was not triggered by dlm_engine_updater, exiting")
+            sys.exit(0)
@@ -0,0 +1,70 @@
+import json
+import os
+
+
+class DlmEngineJournalError(Exception):
+    pass
+
+
+class DlmEngineJournal:
+    def __init__(self, path):
+        self._path = path
+        self._data = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as journal:
+                data = json.load(journal)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError):
+            return dict()
+        if not isinstance(data, dict):
+            return dict()
+        return data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.save()
+
+    def pop(self, key, default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.save()
+        return value
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as journal:
+                json.dump(self.data, journal)
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(tmp, self.path)
+        except OSError as err:
+            raise DlmEngineJournalError(f"could not write journal {self.path}: {err}")
+
+    def reset(self):
+        """forget the cached content, the next access reads the file again"""
+        self._data = None
+
+    def clear(self):
+        self._data = dict()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,176 @@
+"""
+read-only status of a running updater on a unix socket below basedir.
+
+the client side is used by the --status command line, it must only import
+the standard library and modules of this package that do the same.
+"""
+
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.startup import LOCK_HELD_TASKS
+from dlm_engine_updater.startup import locked
+from dlm_engine_updater.startup import peek_task
+
+STATUS_SOCKET = "status.sock"
+
+
+class DlmEngineStatus:
+    """
+    the updater keeps its status here, a thread answers every connection
+    with a JSON document and closes it. nothing is read from clients.
+    """
+
+    def __init__(self, log, path, lock_name, domain=None, mode=0o660, lines=0):
+        self._log = log
+        self._path = path
+        self._mode = mode
+        self._mutex = threading.Lock()
+        # script output may hold secrets, it is only served if lines are configured
+        self._output = collections.deque(maxlen=lines) if lines else None
+        self._status = {
+            "pid": os.getpid(),
+            "domain": domain,
+            "lock_name": lock_name,
+            "phase": None,
+            "phase_started": None,
+            "script": None,
+            "script_started": None,
+            "lock": "not held",
+            "lock_wait_started": None,
+        }
+        self._socket = None
+        self._thread = None
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def path(self):
+        return self._path
+
+    def update(self, **values):
+        with self._mutex:
+            self._status.update(values)
+
+    def phase(self, phase):
+        self.update(phase=phase, phase_started=time.time(), script=None, script_started=None)
+
+    def script(self, script):
+        if script is None:
+            self.update(script=None, script_started=None)
+        else:
+            self.update(script=str(script), script_started=time.time())
+
+    def output(self, line):
+        if self._output is None:
+            return
+        with self._mutex:
+            self._output.append(line)
+
+    def snapshot(self):
+        now = time.time()
+        with self._mutex:
+            status = dict(self._status)
+            if self._output is not None:
+                status["output"] = list(self._output)
+        status["running"] = True
+        status["time"] = now
+        for key in ["phase", "script", "lock_wait"]:
+            started = status.get(f"{key}_started")
+            status[f"{key}_elapsed"] = round(now - started, 3) if started else None
+        return status
+
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.bind(self.path)
+            os.chmod(self.path, self._mode)
+            self._socket.listen(16)
+        except OSError as err:
+            self.log.warning(f"could not serve status on {self.path}: {err}")
+            self._socket = None
+            return
+        self._thread = threading.Thread(target=self._serve, name="dlm-status", daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            try:
+                connection.sendall(json.dumps(self.snapshot()).encode())
+            except OSError:
+                pass
+            finally:
+                connection.close()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._socket.shutdown(socket.SHUT_RDWR)
+        self._socket.close()
+        self._thread.join()
+        self._thread = None
+        self._socket = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def query(path, timeout=2.0):
+    """status of the running updater, None if nothing answers on path"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        chunks = list()
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except OSError:
+        return None
+    finally:
+        client.close()
+    try:
+        return json.loads(b"".join(chunks))
+    except ValueError:
+        return None
+
+
+def offline(basedir):
+    """status from the state file and journal if no updater answers"""
+    task = peek_task(basedir)
+    status = {
+        "running": locked(basedir),
+        "phase": task,
+        "lock": "held" if task in LOCK_HELD_TASKS else "not held",
+    }
+    try:
+        with open(f"{basedir}/journal", "r") as journal:
+            data = json.load(journal)
+    except (OSError, ValueError):
+        data = dict()
+    if isinstance(data, dict):
+        status["lock_acquired_at"] = data.get("lock_acquired_at")
+        status["run_id"] = (data.get("history") or {}).get("run_id")
+    return status
+
+
+def status(basedir):
+    return query(os.path.join(basedir, STATUS_SOCKET)) or offline(basedir)
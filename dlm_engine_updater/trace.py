@@ -0,0 +1,222 @@
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.state import DlmEngineJournal
+from dlm_engine_updater.state import DlmEngineJournalError
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class DlmEngineSpan:
+    def __init__(self, name, trace_id, parent_id, kind, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.status = STATUS_OK
+
+    def otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end or time.time_ns()),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class DlmEngineTracer:
+    """
+    OpenTelemetry compatible spans, appended to an OTLP-JSON lines file.
+
+    the root span of an update run lives in the state journal, so the
+    processes before and after a reboot emit their spans into the same
+    trace. the root span itself is emitted once the run is finished.
+    """
+
+    def __init__(self, log, path, journal, lock_name):
+        self._log = log
+        self._path = path
+        self._journal = journal
+        self._lock_name = lock_name
+        self._run = None
+        self._local = threading.local()
+        self._spans = list()
+
+    @property
+    def log(self) -> DlmLogger:
+        return self._log
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def journal(self) -> DlmEngineJournal:
+        return self._journal
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    @property
+    def run(self) -> dict:
+        if self._run is None:
+            self._run = self.journal.get("trace")
+            if not self._run:
+                self._run = {
+                    "trace_id": os.urandom(16).hex(),
+                    "span_id": os.urandom(8).hex(),
+                    "start": time.time_ns(),
+                }
+                try:
+                    self.journal.set("trace", self._run)
+                except DlmEngineJournalError as err:
+                    self.log.warning(f"could not persist trace context: {err}")
+        return self._run
+
+    @property
+    def _stack(self):
+        """open spans of the calling thread, the lock is acquired in a thread of its own"""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = list()
+        return stack
+
+    @property
+    def current_span_id(self):
+        if self._stack:
+            return self._stack[-1].span_id
+        return getattr(self._local, "parent_id", None) or self.run["span_id"]
+
+    @contextlib.contextmanager
+    def parent(self, span_id):
+        """spans the calling thread opens outside of other spans become children of span_id"""
+        self._local.parent_id = span_id
+        try:
+            yield
+        finally:
+            self._local.parent_id = None
+
+    def traceparent(self):
+        if not self.enabled:
+            return None
+        return f"00-{self.run['trace_id']}-{self.current_span_id}-01"
+
+    @contextlib.contextmanager
+    def span(self, name, attributes=None, kind=SPAN_KIND_INTERNAL):
+        if not self.enabled:
+            yield None
+            return
+        span = DlmEngineSpan(
+            name=name,
+            trace_id=self.run["trace_id"],
+            parent_id=self.current_span_id,
+            kind=kind,
+            attributes=attributes,
+        )
+        self._stack.append(span)
+        try:
+            yield span
+        except SystemExit as err:
+            if err.code:
+                span.status = STATUS_ERROR
+                span.attributes["exit_code"] = str(err.code)
+            raise
+        except BaseException as err:
+            span.status = STATUS_ERROR
+            span.attributes["exception"] = repr(err)
+            raise
+        finally:
+            span.end = time.time_ns()
+            self._stack.remove(span)
+            self._spans.append(span)
+
+    def finish(self, done):
+        """
+        write the spans of this process, if the run is done also the root
+        span, and drop the trace context from the journal.
+        """
+        if not self.enabled or (not self._spans and not done):
+            return
+        spans = [span.otlp() for span in self._spans]
+        if done and self._run:
+            root = DlmEngineSpan(
+                name="dlm_engine_updater run",
+                trace_id=self._run["trace_id"],
+                parent_id=None,
+                kind=SPAN_KIND_INTERNAL,
+                attributes={"dlm.lock_name": self._lock_name},
+            )
+            root.span_id = self._run["span_id"]
+            root.start = self._run["start"]
+            root.end = time.time_ns()
+            spans.append(root.otlp())
+        self._write(spans)
+        self._spans = list()
+        if done:
+            self._run = None
+            try:
+                self.journal.pop("trace")
+                if not self.journal.data:
+                    self.journal.clear()
+            except (DlmEngineJournalError, OSError) as err:
+                self.log.warning(f"could not drop trace context: {err}")
+
+    def _write(self, spans):
+        if not spans:
+            return
+        record = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            _attribute("service.name", "dlm_engine_updater"),
+                            _attribute("host.name", socket.getfqdn()),
+                            _attribute("process.pid", os.getpid()),
+                        ]
+                    },
+                    "scopeSpans": [
+                        {"scope": {"name": "dlm_engine_updater"}, "spans": spans}
+                    ],
+                }
+            ]
+        }
+        try:
+            with open(self.path, "a") as trace:
+                trace.write(json.dumps(record) + "\n")
+        except OSError as err:
+            self.log.warning(f"could not write trace to {self.path}: {err}")
+
+    def reset(self):
+        self._run = None
+        self._local = threading.local()
+        self._spans = list()
@@ -1,35 +1,94 @@
-import calendar
 import datetime
+import hashlib
+import inspect
 import subprocess
 import os
 import pwd
 import random
+import socket
 import stat
 import sys
 import time
 
-from pep3143daemon import PidFile
-
+from dlm_engine_updater.cache import DlmEngineNeedsUpdateCache
 from dlm_engine_updater.config import DlmUpdaterConfig
+from dlm_engine_updater.constraint import DlmEngineCalendar
+from dlm_engine_updater.constraint import DlmEngineConstraintError
+from dlm_engine_updater.constraint import slot
+from dlm_engine_updater.guard import DlmEngineGuard
+from dlm_engine_updater.history import DlmEngineHistory
 from dlm_engine_updater.lock import DlmEngineLock
 from dlm_engine_updater.logger import DlmLogger
+from dlm_engine_updater.logger import DlmLoggerContext
+from dlm_engine_updater.metrics import DlmEngineMetrics
+from dlm_engine_updater.metrics import PROM_FILE
 from dlm_engine_updater.plugin import DlmEnginePluginManager
+from dlm_engine_updater.plugin import DlmEngineStep
 from dlm_engine_updater.plugin import PluginHookType
 from dlm_engine_updater.plugin import PluginTiming
+from dlm_engine_updater.profiler import DlmEngineProfiler
+from dlm_engine_updater.resources import DlmEngineCgroup
+from dlm_engine_updater.resources import exit_code
+from dlm_engine_updater.resources import rusage_delta
+from dlm_engine_updater.resources import rusage_dict
+from dlm_engine_updater.resources import rusage_format
+from dlm_engine_updater.resources import rusage_thread
+from dlm_engine_updater.startup import LOCK_HELD_TASKS
+from dlm_engine_updater.state import DlmEngineJournal
+from dlm_engine_updater.status import DlmEngineStatus
+from dlm_engine_updater.status import STATUS_SOCKET
+from dlm_engine_updater.state import DlmEngineJournalError
+from dlm_engine_updater.trace import DlmEngineTracer
 
 
 class DlmEngineUpdater:
-    def __init__(self, cfg, after_reboot, date_constraint, random_sleep):
-        self._config = DlmUpdaterConfig(_env_file=cfg)
-        self._plugin_manager = DlmEnginePluginManager(self._config)
-        self._log = DlmLogger(self._config, plugin_manager=self._plugin_manager)
-        self._plugin_manager.log = self._log
-        self._plugin_manager.init()
+    def __init__(
+        self,
+        cfg,
+        after_reboot,
+        date_constraint,
+        random_sleep,
+        rerun=False,
+        calendar=None,
+        blackout=None,
+        timezone=None,
+        profile=None,
+        deadline=None,
+        domain=None,
+        config=None,
+        plugin_manager=None,
+    ):
+        # the domain coordinator hands in its parsed config and initialized plugins
+        if config is None:
+            config = DlmUpdaterConfig(_env_file=cfg)
+        self._config = config.model_copy()
+        self._domain = domain
+        if domain:
+            self.config_domain(domain)
+        if plugin_manager is None:
+            plugin_manager = DlmEnginePluginManager(self._config)
+        self._plugin_manager = plugin_manager
+        self._log = DlmLogger(
+            self._config, plugin_manager=self._plugin_manager, domain=domain
+        )
+        if not self._plugin_manager.log:
+            self._plugin_manager.log = self._log
+            self._plugin_manager.init()
         self._after_reboot = after_reboot
         self._date_constraints = None
         self._random_sleep = random_sleep
-        self._lock = PidFile(f"{self.config.main.basedir}/lock")
-        self.date_constraints = date_constraint
+        self._lock = DlmEngineGuard(self.config.main.basedir, log=self.log)
+        self._journal = DlmEngineJournal(f"{self.config.main.basedir}/journal")
+        self._rerun = rerun
+        self.date_constraints_set(date_constraint, calendar, blackout, timezone)
+        self._deadline = deadline
+        self.deadline()
+        self._tracer = DlmEngineTracer(
+            log=self.log,
+            path=self.config.main.trace.file,
+            journal=self.journal,
+            lock_name=self.config.main.api.lockname,
+        )
         self._dlm_lock = DlmEngineLock(
             log=self.log,
             ca=self.config.main.api.ca,
@@ -40,10 +99,88 @@ class DlmEngineUpdater:
             wait=self.config.main.wait,
             wait_max=self._config.main.waitmax,
             noop=self.config.main.api.noop,
+            tracer=self._tracer,
+            queue=self.config.main.lock.queue,
+            priority=self.config.main.lock.priority,
+            queue_poll=self.config.main.lock.queuepoll,
         )
         self._dlm_lock_acquired = False
+        self._metrics = DlmEngineMetrics(
+            log=self.log,
+            directory=self.config.main.metrics.dir,
+            path=f"{self.config.main.basedir}/metrics.json",
+            lock_name=self.config.main.api.lockname,
+            prom_file=f"dlm_engine_updater_{domain}.prom" if domain else PROM_FILE,
+        )
+        self._history = DlmEngineHistory(
+            log=self.log,
+            path=f"{self.config.main.basedir}/history.db",
+            journal=self.journal,
+            lock_name=self.config.main.api.lockname,
+            enabled=self.config.main.history.enabled,
+            retention=self.config.main.history.retention,
+            max_runs=self.config.main.history.maxruns,
+        )
+        self._outcome = None
+        self._profiler = None
+        if profile is None and self.config.main.profile.enabled:
+            profile = self.config.main.profile.mode
+        if profile:
+            try:
+                self._profiler = DlmEngineProfiler(
+                    log=self.log,
+                    mode=profile,
+                    directory=os.path.join(self.config.main.profile.dir, domain or ""),
+                    top=self.config.main.profile.top,
+                    interval=self.config.main.profile.interval,
+                )
+            except ValueError as err:
+                self.log.fatal(f"invalid profile configuration: {err}")
+                sys.exit(1)
+        self._status = None
+        if self.config.main.status.enabled:
+            self._status = DlmEngineStatus(
+                log=self.log,
+                path=os.path.join(self.config.main.basedir, STATUS_SOCKET),
+                lock_name=self.config.main.api.lockname,
+                domain=domain,
+                mode=int(self.config.main.status.mode, 8),
+                lines=self.config.main.status.lines,
+            )
+            self.dlm_lock.on_position = self._lock_position
+        self._cgroup = None
+        if self.config.main.cgroup.enabled:
+            self._cgroup = DlmEngineCgroup(
+                log=self.log,
+                path=self.config.main.cgroup.path,
+                cpu_weight=self.config.main.cgroup.cpuweight,
+                memory_max=self.config.main.cgroup.memorymax,
+                io_weight=self.config.main.cgroup.ioweight,
+            )
+        self._needs_update_cache = None
+        if self.config.main.cache.enabled:
+            self._needs_update_cache = DlmEngineNeedsUpdateCache(
+                log=self.log,
+                path=f"{self.config.main.basedir}/needs_update.cache",
+                ttl=self.config.main.cache.ttl,
+                fingerprint_cmd=self.config.main.cache.fingerprintcmd,
+                fingerprint_files=self.config.main.cache.fingerprintfiles,
+            )
         self._user_scripts_users = None
         self._user_root = None
+        self._reboot_defer = False
+        self._reboot_pending = False
+
+    def config_domain(self, domain):
+        """run with the lock name and basedir of an update domain"""
+        domains = self.config.domain or {}
+        if domain not in domains:
+            print(f"unknown update domain {domain}")
+            sys.exit(1)
+        settings = domains[domain]
+        self._config.main = self.config.main.model_copy(deep=True)
+        self._config.main.api.lockname = settings.lockname
+        self._config.main.basedir = settings.basedir or f"{self.config.main.basedir}/{domain}"
 
     @property
     def log(self) -> DlmLogger:
@@ -58,41 +195,21 @@ class DlmEngineUpdater:
         return self._config
 
     @property
-    def date_constraints(self):
+    def date_constraints(self) -> DlmEngineCalendar:
         return self._date_constraints
 
-    @date_constraints.setter
-    def date_constraints(self, constraints):
-        if not constraints:
-            return
-        constraints = constraints.split(",")
-        _constraints = list()
-        for constraint in constraints:
-            self.log.info(f"parsing date constraint: {constraint}")
-            try:
-                nth, day = constraint.split(":", maxsplit=1)
-            except ValueError:
-                self.log.fatal("Invalid date constraint, must match NUM:DAY_ABBR")
-                sys.exit(1)
-            try:
-                nth = int(nth)
-            except ValueError:
-                self.log.fatal(
-                    "Invalid date constraint, number must be between 1 and 5"
-                )
-                sys.exit(1)
-            if nth not in range(1, 6):
-                self.log.fatal(
-                    "Invalid date constraint, number must be between 1 and 5"
-                )
-                sys.exit(1)
-            if day not in calendar.day_abbr:
-                self.log.fatal(
-                    f"Invalid date constraint, day must be one of {list(calendar.day_abbr)}"
-                )
-                sys.exit(1)
-            _constraints.append({"nth": nth, "day": day})
-        self._date_constraints = _constraints
+    def date_constraints_set(self, date_constraint, calendar, blackout, timezone):
+        self.log.info("parsing date constraints")
+        try:
+            self._date_constraints = DlmEngineCalendar.from_args(
+                date_constraint=date_constraint,
+                calendar=calendar,
+                blackout=blackout,
+                timezone=timezone,
+            )
+        except DlmEngineConstraintError as err:
+            self.log.fatal(f"Invalid date constraint: {err}")
+            sys.exit(1)
 
     @property
     def dlm_lock(self):
@@ -107,9 +224,69 @@ class DlmEngineUpdater:
         self._dlm_lock_acquired = value
 
     @property
-    def lock(self):
+    def lock(self) -> DlmEngineGuard:
         return self._lock
 
+    @lock.setter
+    def lock(self, value):
+        self._lock = value
+
+    @property
+    def tracer(self) -> DlmEngineTracer:
+        return self._tracer
+
+    @property
+    def domain(self):
+        return self._domain
+
+    @property
+    def reboot_defer(self):
+        return self._reboot_defer
+
+    @reboot_defer.setter
+    def reboot_defer(self, value):
+        self._reboot_defer = value
+
+    @property
+    def reboot_pending(self):
+        return self._reboot_pending
+
+    @property
+    def status(self) -> DlmEngineStatus:
+        return self._status
+
+    @property
+    def cgroup(self) -> DlmEngineCgroup:
+        return self._cgroup
+
+    @property
+    def history(self) -> DlmEngineHistory:
+        return self._history
+
+    @property
+    def profiler(self) -> DlmEngineProfiler:
+        return self._profiler
+
+    @property
+    def metrics(self) -> DlmEngineMetrics:
+        return self._metrics
+
+    @property
+    def needs_update_cache(self) -> DlmEngineNeedsUpdateCache:
+        return self._needs_update_cache
+
+    @property
+    def journal(self) -> DlmEngineJournal:
+        return self._journal
+
+    @property
+    def rerun(self):
+        return self._rerun
+
+    @rerun.setter
+    def rerun(self, value):
+        self._rerun = value
+
     @property
     def after_reboot(self):
         return self._after_reboot
@@ -139,17 +316,82 @@ class DlmEngineUpdater:
             self._user_root = pwd.getpwnam(_user)
         return self._user_root
 
+    def reset(self):
+        self._dlm_lock_acquired = False
+        self._user_scripts_users = None
+        self._user_root = None
+        self.journal.reset()
+        self.tracer.reset()
+        self.history.reset()
+        self._outcome = None
+        self._reboot_pending = False
+        if self.needs_update_cache:
+            self.needs_update_cache.reset()
+
+    def close(self):
+        if self.status:
+            self.status.stop()
+        self.dlm_lock.close()
+        self.history.close()
+        self.log.close()
+
     def random_sleep(self):
+        if self.config.main.slot.enabled and self._random_sleep:
+            self.slot_sleep()
+            return
         sleep = random.randint(0, self._random_sleep)
         self.log.info(f"sleeping {sleep} seconds")
-        time.sleep(sleep)
+        if self.lock.sleep(sleep):
+            self.log.info("resume after reboot requested, sleep cut short")
+            return
         self.log.info(f"sleeping {sleep} seconds,done ")
 
+    def slot_sleep(self):
+        """
+        sleep until the slot of this host, the offset is counted from the
+        start of the calendar window, or from now without calendar.
+        """
+        start = self.date_constraints.window_start()
+        if start:
+            window = start.isoformat()
+            base = start.timestamp()
+        else:
+            window = self.date_constraints.now().date().isoformat()
+            base = time.time()
+        identity = self.config.main.slot.identity or socket.getfqdn()
+        offset = slot(
+            identity,
+            self.config.main.api.lockname,
+            window,
+            self._random_sleep,
+            jitter=self.config.main.slot.jitter,
+        )
+        sleep = max(0.0, base + offset - time.time())
+        self.log.info(
+            f"slot of {identity} at {offset:.0f} of {self._random_sleep} seconds "
+            f"in window {window}, sleeping {sleep:.0f} seconds"
+        )
+        if self.status:
+            self.status.update(slot_offset=round(offset, 3), slot_window=window)
+        if self.lock.sleep(sleep):
+            self.log.info("resume after reboot requested, sleep cut short")
+            return
+        self.log.info(f"sleeping {sleep:.0f} seconds, done")
+
     def execute_shell(self, args, user, phase, script, env=None):
+        return self._execute_shell(args, user, phase, script, env)[0]
+
+    def _execute_shell(self, args, user, phase, script, env=None):
+        """returns the exit code and resource usage of the child"""
         if not env:
             env = {}
         env["DLM_ENGINE_UPDATER_LOCK_NAME"] = self.dlm_lock.lock_name
         env["DLM_ENGINE_UPDATER_PHASE"] = self.task
+        if self.domain:
+            env["DLM_ENGINE_UPDATER_DOMAIN"] = self.domain
+        traceparent = self.tracer.traceparent()
+        if traceparent:
+            env["TRACEPARENT"] = traceparent
         env.setdefault(
             "PATH", "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
         )
@@ -159,6 +401,12 @@ class DlmEngineUpdater:
         env.setdefault("HOME", pwent.pw_dir)
         if user != "root":
             args = ["sudo", "-n", "-E", "-u", user] + args
+        # the command may not return, for example a reboot
+        self.log.index_flush()
+        peak = None
+        if self.cgroup:
+            args = self.cgroup.wrap(args)
+            peak = self.cgroup.peak_open()
         p = subprocess.Popen(
             args,
             env=env,
@@ -168,10 +416,25 @@ class DlmEngineUpdater:
         )
         for line in p.stdout:
             self.log.info(line.rstrip(), phase=phase, script=script)
+            if self.status:
+                self.status.output(line.rstrip())
         p.stdout.close()
-        p_wait = p.wait()
-        self.log.info("subprocess finished", phase=phase, script=script, return_code=p_wait)
-        return p_wait
+        # wait4 instead of p.wait() to get the resource usage of the child
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = p_wait = exit_code(status)
+        usage = rusage_dict(rusage)
+        if peak is not None:
+            max_rss = self.cgroup.peak_read(peak)
+            if max_rss is not None:
+                usage["max_rss"] = max_rss
+        self.log.info(
+            f"subprocess finished, {rusage_format(usage)}",
+            phase=phase,
+            script=script,
+            return_code=p_wait,
+            rusage=usage,
+        )
+        return p_wait, usage
 
     @property
     def task(self):
@@ -187,6 +450,10 @@ class DlmEngineUpdater:
             os.remove(f"{self.config.main.basedir}/state")
         except OSError as err:
             self.log.error(f"could not remove state file: {err}")
+        try:
+            self.journal.clear()
+        except OSError as err:
+            self.log.error(f"could not remove journal: {err}")
 
     @task.setter
     def task(self, task):
@@ -203,33 +470,17 @@ class DlmEngineUpdater:
             self.log.info("no date constraint set")
             return None
         self.log.info("checking date constraints")
-        for constraint in self.date_constraints:
-            if self._check_date_constraint(
-                nth=constraint["nth"],
-                day=constraint["day"],
-            ):
-                return True
-        self.log.warning("no date constraint matched")
-        sys.exit(0)
-
-    def _check_date_constraint(self, nth, day):
-        self.log.info(f"checking constraint {nth}:{day}")
-        now = datetime.datetime.now()
-        if now.strftime("%a") != day:
-            self.log.info(f"today is not {day}")
-            return False
-
-        nth_count = 0
-        current_date = datetime.datetime(year=now.year, month=now.month, day=1)
-        while current_date.month == now.month and current_date <= now:
-            if current_date.strftime("%a") == day:
-                nth_count += 1
-            current_date += datetime.timedelta(days=1)
-
-        if nth_count != nth:
-            self.log.info(f"today is not the {nth}. {day}")
-            return False
-        self.log.info(f"today is the {nth}. {day}, running dlm_engine_updater")
+        now = self.date_constraints.now()
+        if not self.date_constraints.allowed(now):
+            self.log.warning("no date constraint matched")
+            window = self.date_constraints.next_window(now)
+            if window:
+                self.log.info(f"next allowed window starts {window[0].isoformat()}")
+            sys.exit(0)
+        rule = self.date_constraints.matching_rule(now)
+        if rule:
+            self.log.info(f"{now} matches {rule.expression}")
+        self.log.info("date constraints fulfilled, running dlm_engine_updater")
         return True
 
     def check_reboot(self):
@@ -242,9 +493,115 @@ class DlmEngineUpdater:
                     "reboot was triggered by dlm_engine_updater, picking up remaining tasks"
                 )
 
+    def deadline(self):
+        try:
+            # a window that ends at the top of the hour would skip every run, the window end is opt-in
+            return self.date_constraints.deadline(
+                self._deadline,
+                window=bool(self._deadline) or self.config.main.deadline.window,
+            )
+        except DlmEngineConstraintError as err:
+            self.log.fatal(f"Invalid deadline: {err}")
+            sys.exit(1)
+
+    def lock_deadline(self):
+        """latest time to acquire the lock and still finish before the deadline"""
+        deadline = self.deadline()
+        if deadline is None:
+            return None
+        estimate = self.history.estimate(
+            LOCK_HELD_TASKS,
+            pct=self.config.main.deadline.percentile,
+            runs=self.config.main.deadline.runs,
+        )
+        if estimate is None:
+            self.log.info(
+                "no successful run in the history, cannot estimate the lock hold duration",
+                phase="lock_get",
+            )
+            estimate = 0.0
+        latest = deadline.timestamp() - estimate - self.config.main.deadline.margin
+        self.log.info(
+            f"deadline is {deadline.isoformat()}, expecting to hold the lock for {estimate:.0f} seconds, "
+            f"acquiring it until {datetime.datetime.fromtimestamp(latest).isoformat()}",
+            phase="lock_get",
+        )
+        return latest
+
+    def deadline_skip(self):
+        self.log.warning(
+            "update would not finish before the deadline, not acquiring the lock",
+            phase="lock_get",
+        )
+        self._outcome = "deadline"
+        self.do_ext_notify(
+            phase="main", script="none", return_code=0, updater_running=False
+        )
+        sys.exit(0)
+
+    def dlm_lock_speculate(self):
+        if self.get_scripts("prefetch.d", phase="prefetch"):
+            # the lock would be held while prefetch runs, the phase exists to avoid that
+            self.log.info(
+                "prefetch scripts found, not acquiring the lock in the background",
+                phase="needs_update",
+            )
+            return
+        latest = self.lock_deadline()
+        if latest is not None and time.time() > latest:
+            self.log.info(
+                "deadline too close, not acquiring the lock in the background",
+                phase="needs_update",
+            )
+            return
+        self.log.info(
+            "acquiring the lock in the background while checking for updates",
+            phase="needs_update",
+        )
+        if self.status:
+            self.status.update(lock="waiting", lock_wait_started=time.time())
+        self.dlm_lock.acquire_start(deadline=latest)
+
+    def _lock_position(self, position):
+        self.status.update(lock_queue_position=position)
+
+    def dlm_lock_speculate_cancel(self):
+        if not self.dlm_lock.pending:
+            return
+        try:
+            self.dlm_lock.acquire_cancel()
+        except SystemExit:
+            self.log.error("could not release the lock acquired in the background")
+        if self.status:
+            self.status.update(lock="not held", lock_wait_started=None)
+
     def dlm_lock_get(self):
-        self.dlm_lock.acquire()
+        latest = self.lock_deadline()
+        if latest is not None and time.time() > latest:
+            self.deadline_skip()
+        if self.status and not self.dlm_lock.pending:
+            self.status.update(lock="waiting", lock_wait_started=time.time())
+        try:
+            if self.dlm_lock.pending:
+                acquired = self.dlm_lock.acquire_join()
+            else:
+                acquired = self.dlm_lock.acquire(deadline=latest)
+        finally:
+            self.metrics.lock_wait(self.dlm_lock.waited, self.dlm_lock.attempts)
+            self.history.update(
+                lock_wait=self.dlm_lock.waited, lock_attempts=self.dlm_lock.attempts
+            )
+        if not acquired:
+            self.deadline_skip()
         self.dlm_lock_acquired = True
+        if self.status:
+            self.status.update(lock="held", lock_wait_started=None)
+        acquired_at = self.dlm_lock.acquired_at or time.time()
+        try:
+            self.journal.set("lock_acquired_at", acquired_at)
+        except DlmEngineJournalError as err:
+            self.log.warning(f"could not record lock acquisition time: {err}")
+        self.history.update(lock_acquired=acquired_at)
         self.do_ext_notify(phase="main", script="none", return_code=0)
         self.task = "pre_update"
 
@@ -252,13 +609,27 @@ class DlmEngineUpdater:
         self.log.info("releasing lock")
         self.dlm_lock.release()
         self.dlm_lock_acquired = False
-        self.do_ext_notify(
-            phase="main", script="none", return_code=0, updater_running=False
-        )
-        del self.task
-        sys.exit(0)
+        if self.status:
+            self.status.update(lock="not held")
+        if self.needs_update_cache:
+            self.needs_update_cache.invalidate()
+        released_at = time.time()
+        acquired_at = self.journal.get("lock_acquired_at")
+        if acquired_at:
+            self.metrics.lock_hold(released_at - acquired_at)
+        self.history.update(lock_released=released_at)
+        self.do_ext_notify(phase="main", script="none", return_code=0)
+        self.task = "post_release"
 
     def do_ext_notify(self, phase, script, return_code, updater_running=True):
+        start = time.monotonic()
+        try:
+            with self.tracer.span("ext_notify", attributes={"dlm.phase": phase}):
+                self._do_ext_notify(phase, script, return_code, updater_running)
+        finally:
+            self.metrics.notifier(time.monotonic() - start)
+
+    def _do_ext_notify(self, phase, script, return_code, updater_running):
         files = self.get_scripts("ext_notify.d", phase=phase)
         for _file, _user in files:
             self.log.info(f"running ext notify script: {_file}")
@@ -269,7 +640,7 @@ class DlmEngineUpdater:
                     str(self.dlm_lock_acquired),
                     str(updater_running),
                     phase,
-                    script,
+                    str(script),
                     str(return_code),
                 ],
                 user=_user,
@@ -288,7 +659,7 @@ class DlmEngineUpdater:
                     str(self.dlm_lock_acquired),
                     str(updater_running),
                     phase,
-                    script,
+                    str(script),
                     str(return_code),
                 ],
                 user=_user,
@@ -308,9 +679,20 @@ class DlmEngineUpdater:
                 for script in self._get_scripts(_path, user, phase=phase):
                     scripts.append([script, user.pw_name])
 
-        scripts.sort(key=lambda x: os.path.basename(x[0]))
+        # steps belong to the phase directories, not to ext_notify.d and on_failure.d
+        if path == f"{phase}.d":
+            for step in self.plugin_manager.steps(phase):
+                scripts.append([step, self.user_root.pw_name])
+
+        scripts.sort(key=self._script_sort_key)
         return scripts
 
+    @staticmethod
+    def _script_sort_key(script):
+        if isinstance(script[0], DlmEngineStep):
+            return script[0].name
+        return os.path.basename(script[0])
+
     def _get_scripts(self, path, user, phase):
         user_name = user.pw_name
 
@@ -339,15 +721,172 @@ class DlmEngineUpdater:
             files.append(_file)
         return files
 
+    def execute_step(self, step, phase):
+        """returns the return code and resource usage of the step"""
+        script = str(step)
+        before = rusage_thread()
+        try:
+            return_code = step.run(
+                phase=phase,
+                log=DlmLoggerContext(self.log, phase=phase, script=script),
+                lock_name=self.dlm_lock.lock_name,
+                traceparent=self.tracer.traceparent(),
+            )
+        except Exception as err:
+            self.log.error(f"step raised: {err!r}", phase=phase, script=script)
+            return_code = 1
+        if return_code is None:
+            return_code = 0
+        usage = rusage_delta(before, rusage_thread())
+        self.log.info(
+            f"step finished, {rusage_format(usage)}",
+            phase=phase,
+            script=script,
+            return_code=return_code,
+            rusage=usage,
+        )
+        return return_code, usage
+
+    def run_script(self, script, user, phase):
+        started = time.time()
+        start = time.monotonic()
+        if isinstance(script, DlmEngineStep):
+            name = f"step {script}"
+        else:
+            name = f"script {os.path.basename(script)}"
+        if self.status:
+            self.status.script(script)
+        with self.tracer.span(
+            name,
+            attributes={"dlm.phase": phase, "dlm.script": str(script), "dlm.user": user},
+        ) as span:
+            try:
+                if isinstance(script, DlmEngineStep):
+                    return_code, usage = self.execute_step(script, phase=phase)
+                else:
+                    return_code, usage = self._execute_shell(
+                        [script], user=user, phase=phase, script=script
+                    )
+            finally:
+                if self.status:
+                    self.status.script(None)
+            if span:
+                span.attributes["dlm.return_code"] = return_code
+                span.attributes["dlm.cpu_seconds"] = usage["cpu_user"] + usage["cpu_system"]
+        duration = time.monotonic() - start
+        self.metrics.script(phase, str(script), duration, return_code)
+        self.history.script(
+            phase, str(script), user, started, duration, return_code, usage=usage
+        )
+        return return_code
+
+    def checkpoint(self, script, user):
+        path = script
+        if isinstance(script, DlmEngineStep):
+            # a step is identified by the module file that defines it
+            try:
+                path = inspect.getsourcefile(type(script))
+            except TypeError:
+                path = None
+            if not path:
+                self.log.warning(f"could not find the source of step {script}")
+                return None
+        sha256 = hashlib.sha256()
+        try:
+            with open(path, "rb") as _script:
+                for chunk in iter(lambda: _script.read(65536), b""):
+                    sha256.update(chunk)
+        except OSError as err:
+            self.log.warning(f"could not hash {path}: {err}")
+            return None
+        return {"path": str(script), "sha256": sha256.hexdigest(), "owner": user}
+
+    def checkpoints(self, phase):
+        return self.journal.get("checkpoints", {}).get(phase, [])
+
+    def checkpoint_add(self, phase, checkpoint):
+        if not checkpoint:
+            return
+        checkpoints = self.journal.get("checkpoints", {})
+        checkpoints.setdefault(phase, []).append(checkpoint)
+        try:
+            self.journal.set("checkpoints", checkpoints)
+        except DlmEngineJournalError as err:
+            self.log.warning(f"could not record checkpoint: {err}", phase=phase)
+
+    def checkpoints_reset(self):
+        self.log.info("rerun requested, dropping script checkpoints")
+        try:
+            self.journal.pop("checkpoints")
+        except DlmEngineJournalError as err:
+            self.log.fatal(f"could not drop checkpoints: {err}")
+            sys.exit(1)
+
+    def run_scripts(
+        self,
+        path,
+        phase,
+        skip_user_scripts=True,
+        keep_lock=True,
+        ignore_failures=False,
+    ):
+        files = self.get_scripts(path, skip_user_scripts=skip_user_scripts, phase=phase)
+        completed = self.checkpoints(phase)
+        for _file, _user in files:
+            checkpoint = self.checkpoint(_file, _user)
+            if checkpoint and checkpoint in completed:
+                self.log.info(
+                    f"skipping: {_file}, completed in a previous run", phase=phase
+                )
+                continue
+            self.log.info(f"running: {_file}", phase=phase)
+            return_code = self.run_script(_file, _user, phase=phase)
+            if return_code != 0 and ignore_failures:
+                self.log.warning("script failed, continuing", phase=phase)
+                self.on_failure(phase=phase, script=_file, return_code=return_code)
+                continue
+            if return_code != 0:
+                if keep_lock:
+                    self.log.info("script failed, stopping, keeping lock", phase=phase)
+                else:
+                    self.log.info("script failed, stopping", phase=phase)
+                self.on_failure(phase=phase, script=_file, return_code=return_code)
+                sys.exit(1)
+            self.checkpoint_add(phase, checkpoint)
+            self.do_ext_notify(phase=phase, script=_file, return_code=return_code)
+            self.log.info(f"running: {_file} done", phase=phase)
+
     def needs_update(self):
-        update = False
+        update = None
         self.log.info("checking if updates are available", phase="needs_update")
+        self.metrics.run_start()
+        if self.needs_update_cache:
+            update = self.needs_update_cache.get()
+        if update is None:
+            if self.config.main.lock.speculative:
+                self.dlm_lock_speculate()
+            update = self._needs_update()
+            if self.needs_update_cache:
+                self.needs_update_cache.set(update)
+        elif update:
+            self.log.info("updates are available", phase="needs_update")
+        if update:
+            self.task = "prefetch"
+        else:
+            self.log.info("no updates available", phase="needs_update")
+            self._outcome = "no_updates"
+            self.dlm_lock_speculate_cancel()
+            self.do_ext_notify(
+                phase="main", script="none", return_code=0, updater_running=False
+            )
+            sys.exit(0)
+
+    def _needs_update(self):
+        update = False
         files = self.get_scripts("needs_update.d", phase="needs_update")
         for _file, _user in files:
             self.log.info(f"running: {_file}", phase="needs_update")
-            return_code = self.execute_shell(
-                [_file], user=_user, phase="needs_update", script=_file
-            )
+            return_code = self.run_script(_file, _user, phase="needs_update")
             if return_code != 0:
                 update = True
             self.do_ext_notify(
@@ -357,103 +896,81 @@ class DlmEngineUpdater:
             if update:
                 self.log.info("updates are available", phase="needs_update")
                 break
+        return update
 
-        if update:
-            self.task = "lock_get"
-        else:
-            self.log.info("no updates available", phase="needs_update")
-            self.do_ext_notify(
-                phase="main", script="none", return_code=0, updater_running=False
-            )
-            sys.exit(0)
+    def prefetch(self):
+        self.log.info("running prefetch scripts", phase="prefetch")
+        self.run_scripts("prefetch.d", phase="prefetch", keep_lock=False)
+        self.task = "lock_get"
 
     def update(self):
         self.log.info("running_update scripts", phase="update")
-        files = self.get_scripts("update.d", phase="update")
-        for _file, _user in files:
-            self.log.info(f"running: {_file}")
-            return_code = self.execute_shell(
-                [_file], user=_user, phase="update", script=_file
-            )
-            if return_code != 0:
-                self.log.info("script failed, stopping, keeping lock", phase="update")
-                self.on_failure(phase="update", script=_file, return_code=return_code)
-                sys.exit(1)
-            self.do_ext_notify(phase="update", script=_file, return_code=return_code)
-            self.log.info(f"running: {_file} done", phase="update")
+        self.run_scripts("update.d", phase="update")
         self.task = "needs_reboot"
 
     def post_update(self):
         self.log.info("running post_update scripts", phase="post_update")
         self.dlm_lock_acquired = True
+        if self.status:
+            self.status.update(lock="held")
+        try:
+            reboot_at = self.journal.pop("reboot_at")
+        except DlmEngineJournalError as err:
+            self.log.warning(f"could not drop reboot time: {err}", phase="post_update")
+            reboot_at = None
+        if reboot_at:
+            self.history.update(reboot_duration=time.time() - reboot_at)
         if not self.plugin_manager.run(
             hook_type=PluginHookType.PHASE,
             timing=PluginTiming.PRE,
+            tracer=self.tracer,
             phase="post_update",
         ):
             self.log.info("post_update plugin failed, stopping", phase="post_update")
             sys.exit(1)
-        files = self.get_scripts(
-            "post_update.d", skip_user_scripts=False, phase="post_update"
-        )
-        for _file, _user in files:
-            self.log.info(f"running: {_file}", phase="post_update")
-            return_code = self.execute_shell(
-                [_file], user=_user, phase="post_update", script=_file
-            )
-            if return_code != 0:
-                self.log.info(
-                    "script failed, stopping, keeping lock", phase="post_update"
-                )
-                self.on_failure(
-                    phase="post_update", script=_file, return_code=return_code
-                )
-                sys.exit(1)
-            self.do_ext_notify(
-                phase="post_update", script=_file, return_code=return_code
-            )
-            self.log.info(f"running: {_file} done", phase="post_update")
+        self.run_scripts("post_update.d", phase="post_update", skip_user_scripts=False)
         if not self.plugin_manager.run(
             hook_type=PluginHookType.PHASE,
             timing=PluginTiming.POST,
+            tracer=self.tracer,
             phase="post_update",
         ):
             self.log.info("post_update plugin failed, stopping", phase="post_update")
             sys.exit(1)
         self.task = "lock_release"
 
+    def post_release(self):
+        self.log.info("running post_release scripts", phase="post_release")
+        self.run_scripts(
+            "post_release.d",
+            phase="post_release",
+            skip_user_scripts=False,
+            keep_lock=False,
+            ignore_failures=self.config.main.postrelease.failure == "ignore",
+        )
+        self.metrics.success()
+        self._outcome = "success"
+        self.do_ext_notify(
+            phase="main", script="none", return_code=0, updater_running=False
+        )
+        del self.task
+        sys.exit(0)
+
     def pre_update(self):
         self.log.info("running pre_update scripts", phase="pre_update")
         if not self.plugin_manager.run(
             hook_type=PluginHookType.PHASE,
             timing=PluginTiming.PRE,
+            tracer=self.tracer,
             phase="pre_update",
         ):
             self.log.info("pre_update plugin failed, stopping", phase="pre_update")
             sys.exit(1)
-        files = self.get_scripts(
-            "pre_update.d", skip_user_scripts=False, phase="pre_update"
-        )
-        for _file, _user in files:
-            self.log.info(f"running: {_file}")
-            return_code = self.execute_shell(
-                [_file], user=_user, phase="pre_update", script=_file
-            )
-            if return_code != 0:
-                self.log.info(
-                    "script failed, stopping, keeping lock", phase="pre_update"
-                )
-                self.on_failure(
-                    phase="pre_update", script=_file, return_code=return_code
-                )
-                sys.exit(1)
-            self.do_ext_notify(
-                phase="pre_update", script=_file, return_code=return_code
-            )
-            self.log.info(f"running: {_file} done", phase="pre_update")
+        self.run_scripts("pre_update.d", phase="pre_update", skip_user_scripts=False)
         if not self.plugin_manager.run(
             hook_type=PluginHookType.PHASE,
             timing=PluginTiming.POST,
+            tracer=self.tracer,
             phase="pre_update",
         ):
             self.log.info("pre_update plugin failed, stopping", phase="pre_update")
@@ -463,18 +980,28 @@ class DlmEngineUpdater:
     def reboot(self):
         self.log.info("rebooting", phase="reboot")
         self.task = "post_update"
+        try:
+            self.journal.set("reboot_at", time.time())
+        except DlmEngineJournalError as err:
+            self.log.warning(f"could not record reboot time: {err}", phase="reboot")
+        if self.reboot_defer:
+            self.log.info("leaving the reboot to the domain coordinator", phase="reboot")
+            self._reboot_pending = True
+            sys.exit(0)
+        self.log.index_flush()
+        self.reboot_run()
+        sys.exit(0)
+
+    def reboot_run(self):
         for _file, _user in self.get_scripts("reboot.d", phase="reboot"):
             self.log.info(f"running: {_file}", phase="reboot")
-            return_code = self.execute_shell(
-                [_file], user=_user, phase="reboot", script=_file
-            )
+            return_code = self.run_script(_file, _user, phase="reboot")
             if return_code != 0:
                 self.log.info("script failed, stopping, keeping lock", phase="reboot")
                 self.on_failure(phase="reboot", script=_file, return_code=return_code)
                 sys.exit(1)
             self.do_ext_notify(phase="reboot", script=_file, return_code=return_code)
             self.log.info(f"running: {_file} done", phase="reboot")
-        sys.exit(0)
 
     def needs_reboot(self):
         self.log.info("running needs reboot scripts", phase="needs_reboot")
@@ -489,9 +1016,7 @@ class DlmEngineUpdater:
         reboot = False
         for _file, _user in files:
             self.log.info(f"running: {_file}", phase="needs_reboot", script=_file)
-            return_code = self.execute_shell(
-                [_file], user=_user, phase="needs_reboot", script=_file
-            )
+            return_code = self.run_script(_file, _user, phase="needs_reboot")
             if return_code != 0:
                 self.log.info(f"running: {_file} done", phase="needs_reboot")
                 self.do_ext_notify(
@@ -511,28 +1036,97 @@ class DlmEngineUpdater:
     def work(self):
         self.log.info(f"running dlm engine updater as {self.user_root.pw_name}")
         self.check_date_constraints()
-        self.lock.acquire()
+        self.lock.acquire(after_reboot=self.after_reboot, wait=self.config.main.guard.wait)
         self.check_reboot()
+        if self.rerun:
+            self.checkpoints_reset()
         self.random_sleep()
-        while True:
-            task = self.task
-            if task == "needs_update":
-                self.needs_update()
-            elif task == "lock_get":
-                self.dlm_lock_get()
-            elif task == "lock_release":
-                self.dlm_lock_release()
-            elif task == "pre_update":
-                self.pre_update()
-            elif task == "update":
-                self.update()
-            elif task == "needs_reboot":
-                self.needs_reboot()
-            elif task == "reboot":
-                self.reboot()
-            elif task == "post_update":
-                self.post_update()
-            else:
-                self.log.fatal(f"found garbage in status file: {self.task}")
-                del self.task
-                sys.exit(1)
+        try:
+            self.run()
+        except SystemExit as err:
+            # invocations coalesced into this one wait for the result
+            self.lock.release(err.code)
+            raise
+        finally:
+            if self.status:
+                self.status.stop()
+
+    @property
+    def tasks(self):
+        return {
+            "needs_update": self.needs_update,
+            "prefetch": self.prefetch,
+            "lock_get": self.dlm_lock_get,
+            "lock_release": self.dlm_lock_release,
+            "post_release": self.post_release,
+            "pre_update": self.pre_update,
+            "update": self.update,
+            "needs_reboot": self.needs_reboot,
+            "reboot": self.reboot,
+            "post_update": self.post_update,
+        }
+
+    def outcome(self, failed):
+        if self._outcome:
+            return self._outcome
+        if failed:
+            return "failed"
+        if self.task == "post_update":
+            return "rebooting"
+        return "interrupted"
+
+    def run(self):
+        failed = True
+        self.log.run_id = self.history.run_id
+        if self.status:
+            self.status.start()
+            if self.task in LOCK_HELD_TASKS:
+                self.status.update(lock="held")
+        try:
+            with self.tracer.span(
+                "dlm_engine_updater process", attributes={"process.pid": os.getpid()}
+            ):
+                while True:
+                    self.run_task(self.task)
+        except SystemExit as err:
+            failed = bool(err.code)
+            raise
+        finally:
+            # a background acquisition that lock_get did not pick up must not keep the lock
+            self.dlm_lock_speculate_cancel()
+            if self.status:
+                self.status.phase("idle")
+                if not self.dlm_lock_acquired and self.task not in LOCK_HELD_TASKS:
+                    self.status.update(lock="not held", lock_wait_started=None)
+            self.metrics.write()
+            done = self.task == "needs_update"
+            self.history.finish(outcome=self.outcome(failed), done=done)
+            self.log.run_id = None
+            self.tracer.finish(done=done)
+
+    def run_task(self, task):
+        if task not in self.tasks:
+            self.log.fatal(f"found garbage in status file: {task}")
+            del self.task
+            sys.exit(1)
+        started = time.time()
+        start = time.monotonic()
+        outcome = "failed"
+        if self.status:
+            self.status.phase(task)
+        try:
+            with self.tracer.span(f"phase {task}", attributes={"dlm.phase": task}):
+                if self.profiler:
+                    with self.profiler.phase(task):
+                        self.tasks[task]()
+                else:
+                    self.tasks[task]()
+            outcome = "ok"
+        except SystemExit as err:
+            if not err.code:
+                outcome = "ok"
+            raise
+        finally:
+            duration = time.monotonic() - start
+            self.metrics.phase(task, duration)
+            self.history.phase(task, started, duration, outcome)
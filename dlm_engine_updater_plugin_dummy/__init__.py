@@ -3,6 +3,13 @@ from typing import Any
 
 from dlm_engine_updater.plugin import DlmEnginePluginBase
 from dlm_engine_updater.plugin import DlmEnginePluginError
+from dlm_engine_updater.plugin import DlmEngineStep
+
+
+class DlmEngineDummyStep(DlmEngineStep):
+    def run(self, phase: str, log, **kwargs: Any) -> int:
+        log.info(f"dummy step {self.name} in phase {phase}")
+        return 0
 
 
 class DlmEnginePlugin(DlmEnginePluginBase):
@@ -36,6 +43,9 @@ class DlmEnginePlugin(DlmEnginePluginBase):
         # print(f"POST {level} {phase} {msg}")
         pass
 
+    def steps(self):
+        return [DlmEngineDummyStep("00-dummy", ["needs_update"])]
+
     def phase_pre_hook(self, phase: str, **kwargs: Any):
         self.log.info(f"dummy plugin phase_pre_hook {phase}", phase=phase)
         return True